@@ -0,0 +1,299 @@
+import asyncio
+import signal
+from contextlib import aclosing
+
+import aiopg
+import psycopg2
+import pytest
+from django.conf import settings
+
+from fan_tools.aio_utils import (
+    DbRecordsProcessorWorker,
+    DbRecordsSupervisor,
+    dict_query,
+    dict_query_one,
+    dict_stream,
+    PgNotifyListener,
+    query_stats,
+    QueryStats,
+    scalar,
+    sql_bulk_insert,
+    sql_bulk_update,
+    sql_update,
+)
+
+
+@pytest.fixture
+def dsn():
+    db = settings.DATABASES['default']
+    return (
+        f"dbname={db['NAME']} user={db['USER']} password={db['PASSWORD']} "
+        f"host={db['HOST']} port={db['PORT']}"
+    )
+
+
+@pytest.fixture
+async def pool(dsn):
+    async with aiopg.create_pool(dsn) as pool:
+        async with pool.acquire() as conn:
+            await sql_update(conn, 'DROP TABLE IF EXISTS aio_records', {})
+            await sql_update(
+                conn,
+                'CREATE TABLE aio_records (id serial PRIMARY KEY, value int, processed int)',
+                {},
+            )
+            await sql_update(
+                conn,
+                'INSERT INTO aio_records (value, processed) '
+                'SELECT generate_series(1, 50), 0',
+                {},
+            )
+        yield pool
+        async with pool.acquire() as conn:
+            await sql_update(conn, 'DROP TABLE aio_records', {})
+
+
+class RecordsWorker:
+    pg_channel = 'aio_records'
+    claim_query = (
+        'SELECT * FROM aio_records WHERE processed = 0 '
+        'ORDER BY id LIMIT %(limit)s FOR UPDATE SKIP LOCKED'
+    )
+    ack_query = 'UPDATE aio_records SET processed = processed + 1 WHERE id = ANY(%(ids)s)'
+
+    def __init__(self, log):
+        self.log = log
+        self.seen = []
+
+    async def process_record(self, record):
+        await asyncio.sleep(0.001)
+        if record['value'] == 7:
+            raise ValueError('broken record')
+        self.seen.append(record['id'])
+
+
+async def test_01_batched_processing(dsn, pool):
+    processors = [
+        DbRecordsProcessorWorker(dsn, RecordsWorker, batch_size=5, concurrency=3) for _ in range(3)
+    ]
+
+    async def drain(processor):
+        async with pool.acquire() as conn:
+            await processor.process_batches(conn)
+
+    await asyncio.gather(*[drain(p) for p in processors])
+
+    seen = [i for p in processors for i in p.worker.seen]
+    assert len(seen) == len(set(seen)) == 49
+    async with pool.acquire() as conn:
+        rows = await dict_query(
+            conn, 'SELECT processed, count(*) FROM aio_records GROUP BY processed', {}
+        )
+    assert sorted((r['processed'], r['count']) for r in rows) == [(0, 1), (1, 49)]
+
+
+async def test_02_listener(dsn, pool):
+    listener = PgNotifyListener(dsn, debounce=0.05)
+    event = listener.subscribe('aio_records')
+    listener.start()
+    # woken up after connect, notifications could be missed before it
+    await asyncio.wait_for(event.wait(), 5)
+    event.clear()
+
+    async with pool.acquire() as conn:
+        for _ in range(10):
+            await sql_update(conn, 'NOTIFY aio_records', {})
+        await asyncio.wait_for(event.wait(), 1)
+        event.clear()
+        # burst is coalesced into single wake up
+        await asyncio.sleep(0.1)
+        assert not event.is_set()
+
+        other = listener.subscribe('aio_other')
+        await asyncio.sleep(0.1)
+        await sql_update(conn, 'NOTIFY aio_other', {})
+        await asyncio.wait_for(other.wait(), 1)
+        assert not event.is_set()
+
+        # LISTENs of simultaneous subscriptions don't clash on the connection
+        many = [listener.subscribe(f'aio_many_{i}') for i in range(5)]
+        await asyncio.sleep(0.1)
+        for i in range(5):
+            await sql_update(conn, f'NOTIFY aio_many_{i}', {})
+        await asyncio.wait_for(asyncio.gather(*[e.wait() for e in many]), 1)
+    await listener.close()
+
+
+async def test_02_listener_subscribe_on_connect(dsn, pool):
+    listener = PgNotifyListener(dsn)
+    listener.start()
+    events = {}
+    # subscriptions made while the listener connects
+    for i in range(50):
+        events[f'aio_many_{i}'] = listener.subscribe(f'aio_many_{i}')
+        await asyncio.sleep(0.002)
+    await asyncio.sleep(0.1)
+    for event in events.values():
+        event.clear()
+
+    async with pool.acquire() as conn:
+        for channel in events:
+            await sql_update(conn, f'NOTIFY {channel}', {})
+    await asyncio.wait_for(asyncio.gather(*[e.wait() for e in events.values()]), 1)
+    await listener.close()
+
+
+class EvenWorker(RecordsWorker):
+    claim_query = (
+        'SELECT * FROM aio_records WHERE processed = 0 AND value %% 2 = 0 '
+        'ORDER BY id LIMIT %(limit)s FOR UPDATE SKIP LOCKED'
+    )
+
+
+class OddWorker(RecordsWorker):
+    pg_channel = 'aio_odd'
+    claim_query = (
+        'SELECT * FROM aio_records WHERE processed = 0 AND value %% 2 = 1 '
+        'ORDER BY id LIMIT %(limit)s FOR UPDATE SKIP LOCKED'
+    )
+
+
+async def test_03_supervisor(dsn, pool):
+    supervisor = DbRecordsSupervisor(
+        dsn,
+        [(EvenWorker, {'batch_size': 4}), (OddWorker, {'batch_size': 3, 'concurrency': 2})],
+        pool_size=2,
+    )
+    task = asyncio.ensure_future(supervisor.serve())
+    try:
+        for _ in range(50):
+            await asyncio.sleep(0.05)
+            if sum(len(p.worker.seen) for p in supervisor.processors) == 49:
+                break
+        even, odd = [p.worker.seen for p in supervisor.processors]
+        assert len(even) == 25 and len(odd) == 24
+
+        async with pool.acquire() as conn:
+            await sql_update(conn, 'UPDATE aio_records SET processed = 0 WHERE id = 1', {})
+            await sql_update(conn, 'NOTIFY aio_odd', {})
+        for _ in range(20):
+            await asyncio.sleep(0.05)
+            if len(odd) == 25:
+                break
+        assert odd.count(1) == 2
+        stats = supervisor.processors[1].stats
+        # broken record is claimed again on every loop
+        assert stats.queries[stats.fingerprint(OddWorker.claim_query)][2] > 25
+    finally:
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+
+def test_03_supervisor_stop_during_restart(monkeypatch):
+    supervisor = DbRecordsSupervisor('', [], processes=2, restart_delay=0)
+    handlers, pids, exited = {}, iter([101, 102, 103]), [101, 102]
+    monkeypatch.setattr(supervisor, '_spawn', lambda: next(pids))
+    monkeypatch.setattr('signal.signal', handlers.__setitem__)
+    monkeypatch.setattr('os.kill', lambda pid, signum: None)
+    monkeypatch.setattr('os.wait', lambda: (exited.pop(0), 0))
+    # SIGTERM arrives while supervisor waits to restart the first exited process
+    monkeypatch.setattr('time.sleep', lambda delay: handlers[signal.SIGTERM](signal.SIGTERM, None))
+    supervisor.run()
+    assert next(pids) == 103
+
+
+async def test_04_stream(pool):
+    query = 'SELECT id, value FROM aio_records WHERE value > %(min)s ORDER BY id'
+    async with pool.acquire() as conn:
+        expected = await dict_query(conn, query, {'min': 10})
+        rows = [r async for r in dict_stream(conn, query, {'min': 10}, itersize=7)]
+        assert rows == expected and len(rows) == 40
+
+        batches = [
+            b async for b in dict_stream(conn, query, {'min': 10}, itersize=8, batches=True)
+        ]
+        assert [len(b) for b in batches] == [8] * 5
+
+        stream = dict_stream(conn, query, {'min': 10}, itersize=3, rows='namedtuple')
+        async with aclosing(stream):
+            async for row in stream:
+                assert (row.id, row.value) == (11, 11)
+                break
+        # transaction is rolled back on early exit, connection is usable
+        tuples = [r async for r in dict_stream(conn, query, {'min': 48}, rows='tuple')]
+        assert tuples == [(49, 49), (50, 50)]
+
+        with pytest.raises(ValueError):
+            [r async for r in dict_stream(conn, query, {'min': 10}, rows='list')]
+
+        assert await dict_query_one(conn, query, {'min': 45}) == {'id': 46, 'value': 46}
+        assert await dict_query_one(conn, query, {'min': 50}) is None
+        assert await scalar(conn, 'SELECT count(*) FROM aio_records', {}) == 50
+        assert await scalar(conn, query, {'min': 50}, default=0) == 0
+
+
+async def test_05_bulk(pool):
+    async with pool.acquire() as conn:
+        counts = await sql_bulk_insert(
+            conn,
+            'aio_records',
+            ['value', 'processed'],
+            [(i, 0) for i in range(100, 130)],
+            max_params=20,
+        )
+        assert counts == [10, 10, 10]
+        assert await scalar(conn, 'SELECT count(*) FROM aio_records', {}) == 80
+
+        counts = await sql_bulk_update(
+            conn,
+            'UPDATE aio_records SET processed = v.processed FROM (VALUES %s) AS v(id, processed) '
+            'WHERE aio_records.id = v.id AND aio_records.value %% 2 = 0',
+            [{'id': i, 'processed': i * 10} for i in range(1, 51)],
+            template='(%(id)s, %(processed)s)',
+            max_params=40,
+        )
+        assert counts == [10, 10, 5]
+        rows = await dict_query(conn, 'SELECT id, processed FROM aio_records WHERE id <= 3', {})
+        assert sorted((r['id'], r['processed']) for r in rows) == [(1, 0), (2, 20), (3, 0)]
+
+        assert await sql_bulk_update(conn, 'UPDATE aio_records SET processed = 1', []) == []
+        with pytest.raises(ValueError):
+            await sql_bulk_update(conn, 'UPDATE aio_records SET processed = 1', [(1,)])
+
+
+async def test_06_prepared_and_stats(pool):
+    stats = QueryStats()
+    query_stats.set(stats)
+    query = 'SELECT id, value FROM aio_records WHERE value > %(min)s AND id < %(max)s ORDER BY id'
+    async with pool.acquire() as conn:
+        for num in range(3):
+            rows = await dict_query(conn, query, {'min': 10, 'max': 20 + num}, prepared=True)
+            assert rows == await dict_query(conn, query, {'min': 10, 'max': 20 + num})
+        assert await scalar(conn, 'SELECT %s::int + %s', [2, 3], prepared=True) == 5
+        await sql_update(
+            conn,
+            'UPDATE aio_records SET processed = 1 WHERE id = ANY(%(ids)s)',
+            {'ids': [1, 2]},
+            prepared=True,
+        )
+        assert await scalar(conn, 'SELECT count(*) FROM pg_prepared_statements', {}) == 3
+
+        # statements deallocated by DISCARD ALL are prepared again
+        await sql_update(conn, 'DISCARD ALL', {})
+        assert await scalar(conn, 'SELECT %s::int + %s', [2, 3], prepared=True) == 5
+        assert await scalar(conn, 'SELECT count(*) FROM pg_prepared_statements', {}) == 1
+
+        # failed transaction can't be retried
+        await sql_update(conn, 'DISCARD ALL', {})
+        async with conn.cursor() as cur:
+            async with cur.begin():
+                with pytest.raises(psycopg2.errors.InvalidSqlStatementName):
+                    await scalar(conn, 'SELECT %s::int + %s', [2, 3], prepared=True)
+        assert await scalar(conn, 'SELECT %s::int + %s', [2, 3], prepared=True) == 5
+
+    summary = {s['query']: s for s in stats.summary()}
+    assert summary[' '.join(query.split())]['count'] == 6
+    assert summary[' '.join(query.split())]['rows'] == 2 * (9 + 10 + 11)
+    assert summary['UPDATE aio_records SET processed = 1 WHERE id = ANY(%(ids)s)']['rows'] == 2
+    assert stats.percentile(query, 50) <= stats.percentile(query, 100)
@@ -4,11 +4,13 @@ from unittest import mock
 
 import pytest
 from django.db import connection, models, transaction
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
 from rest_framework.reverse import reverse
 
 from fan_tools.django import call_once_on_commit
 from fan_tools.django.models import UploadNameGenerator
+from fan_tools.python import chunks
 from pytest_tipsi_django.client_fixtures import UserWrapper
 
 from sampleapp.models import Article, ArticleType, Author, Review
@@ -204,3 +206,17 @@ def test_uploadnamegenerator():
         r'static/imageupload/imageupload-image-.*.jpg',
         UploadNameGenerator('imageupload', 'image')(None, 'file.jpg'),
     )
+
+
+def test_chunks_queryset(articles):
+    queryset = Article.objects.order_by('id')
+    with CaptureQueriesContext(connection) as ctx:
+        parts = chunks(queryset, 4)
+        first = next(parts)
+        # sized by count, rows of a chunk are fetched only when it's evaluated
+        assert len(ctx.captured_queries) == 1
+        assert 'COUNT' in ctx.captured_queries[0]['sql']
+        assert isinstance(first, models.QuerySet)
+    ids = [a.id for a in first] + [a.id for part in parts for a in part]
+    assert ids == list(queryset.values_list('id', flat=True))
+    assert [len(part) for part in chunks(queryset, 4)] == [4, 4, 3]
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Compare execfile startup with and without compiled code cache on a large settings module
+
+python examples/bench_execfile.py -n 50
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import fan_tools.python as fan_python
+from fan_tools.python import execfile
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='execfile cache benchmark')
+    parser.add_argument('-n', '--runs', type=int, default=50)
+    parser.add_argument('-s', '--settings', type=int, default=3000, help='number of settings')
+    return parser.parse_args()
+
+
+def make_settings(pth: Path, size: int):
+    lines = ['import os', '']
+    for i in range(size):
+        lines.append(f'SETTING_{i} = os.environ.get("SETTING_{i}", "default_{i}")')
+        lines.append(f'DICT_{i} = {{"name": "item_{i}", "values": [{i}, {i + 1}], "on": True}}')
+    pth.write_text('\n'.join(lines))
+
+
+def bench(pth: Path, runs: int, cold: bool, **kwargs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        if cold:
+            # every run is a new process: only __pycache__ survives
+            fan_python._code_cache.clear()
+        scope = {}
+        execfile(pth, scope, scope, **kwargs)
+    return (time.perf_counter() - start) / runs
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        pth = Path(tmp) / 'settings.py'
+        make_settings(pth, args.settings)
+        print(f'{pth.stat().st_size // 1024} KiB settings, {args.runs} runs')
+        cases = [
+            ('no cache', False, {}),
+            ('cache=True', False, {'cache': True}),
+            ('persist=True, new process', True, {'persist': True}),
+        ]
+        for name, cold, kwargs in cases:
+            took = bench(pth, args.runs, cold, **kwargs)
+            print(f'{name:<28} {took * 1e3:8.2f} ms/exec')
+
+
+if __name__ == '__main__':
+    main()
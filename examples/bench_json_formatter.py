@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Compare JSFormatter and FastJSFormatter formatting cost per record
+
+python examples/bench_json_formatter.py -n 100000
+"""
+import argparse
+import logging
+import time
+
+from fan_tools.fan_logging import FastJSFormatter, JSFormatter
+
+
+ENV_VARS = ['HOST_TYPE', 'DEPLOYMENT_CONFIG', 'DEPLOYMENT_BRANCH', 'CONTAINER_TYPE']
+DROP_FIELDS = ['asctime', 'msecs', 'relativeCreated', 'processName', 'threadName']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='json formatter benchmark')
+    parser.add_argument('-n', '--records', type=int, default=100000)
+    return parser.parse_args()
+
+
+def make_record():
+    record = logging.LogRecord(
+        'worker.tasks', logging.INFO, __file__, 10, 'Processed %s in %.2fs', ('task', 0.5), None
+    )
+    record.task_id = 'c3b4a0f2'
+    record.retries = 2
+    return record
+
+
+def bench(formatter, records):
+    record = make_record()
+    start = time.perf_counter()
+    for _ in range(records):
+        formatter.format(record)
+    return (time.perf_counter() - start) / records
+
+
+def main():
+    args = parse_args()
+    cases = [
+        ('JSFormatter', JSFormatter(env_vars=ENV_VARS)),
+        ('FastJSFormatter json', FastJSFormatter(env_vars=ENV_VARS, json_encoder='json')),
+        ('FastJSFormatter auto', FastJSFormatter(env_vars=ENV_VARS)),
+        ('FastJSFormatter dropped', FastJSFormatter(env_vars=ENV_VARS, drop_fields=DROP_FIELDS)),
+    ]
+    for name, formatter in cases:
+        took = bench(formatter, args.records)
+        print(f'{name:<24} {took * 1e6:8.2f} us/record')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Compare write/read latency of memoize storage backends
+
+python examples/bench_memoize.py -n 10000
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from fan_tools.python.cache import JsonFileStore, JsonLogStore, SqliteStore
+
+
+BACKENDS = {
+    'json': JsonFileStore,
+    'log': JsonLogStore,
+    'sqlite': SqliteStore,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='memoize storage benchmark')
+    parser.add_argument('-n', '--entries', type=int, default=10000)
+    parser.add_argument(
+        '--json-entries',
+        type=int,
+        default=2000,
+        help='JsonFileStore rewrites everything per write, so it is quadratic',
+    )
+    parser.add_argument('-b', '--backend', action='append', choices=sorted(BACKENDS))
+    return parser.parse_args()
+
+
+def bench(store_cls, pth: Path, n: int):
+    value = {'payload': 'x' * 100, 'items': list(range(10))}
+    store = store_cls(pth)
+    start = time.perf_counter()
+    for i in range(n):
+        store.set(f'key-{i}', value)
+    write = time.perf_counter() - start
+
+    # fresh instance, as another process would see it
+    store = store_cls(pth)
+    start = time.perf_counter()
+    for i in range(n):
+        assert store.get(f'key-{i}') is not None
+    read = time.perf_counter() - start
+    return write, read
+
+
+def main():
+    args = parse_args()
+    names = args.backend or list(BACKENDS)
+    print(f'{"backend":<8} {"entries":>8} {"write us/op":>12} {"read us/op":>12}')
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in names:
+            n = args.json_entries if name == 'json' else args.entries
+            write, read = bench(BACKENDS[name], Path(tmp) / name, n)
+            print(f'{name:<8} {n:>8} {write / n * 1e6:>12.1f} {read / n * 1e6:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,160 @@
 import asyncio
+import itertools
 import logging
+import math
+import os
+import re
+import signal
+import time
+import weakref
+from collections import namedtuple
+from contextlib import nullcontext, suppress
+from contextvars import ContextVar
 
+from psycopg2.errors import InvalidSqlStatementName
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 from psycopg2.extras import DictCursor
 
 import aiopg
 
+from fan_tools.python import agather_limited
+
+
+class PgNotifyListener:
+    """
+    Long-lived connection that LISTENs to channels and wakes up subscribers.
+
+    Bursts of notifications are coalesced: subscriber's event is set once,
+    `debounce` seconds after the first notification. After (re)connect all
+    subscribers are woken up, because notifications could be missed meanwhile.
+    """
+
+    def __init__(self, dsn, log=None, debounce=0.01, reconnect_delay=1):
+        self.dsn = dsn
+        self.log = log or logging.getLogger('processor.listener')
+        self.debounce = debounce
+        self.reconnect_delay = reconnect_delay
+        self.events = {}
+        self.conn = None
+        self.task = None
+        # aiopg connection can't execute concurrently
+        self.lock = asyncio.Lock()
+
+    def subscribe(self, channel):
+        """
+        returns asyncio.Event that is set on notifications, clear it before processing
+        """
+        event = asyncio.Event()
+        if channel not in self.events and self.conn is not None:
+            asyncio.ensure_future(self._listen_new(self.conn, channel))
+        self.events.setdefault(channel, []).append(event)
+        return event
+
+    def start(self):
+        if not self.task:
+            self.task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.task
+            self.task = None
+
+    def _wake(self, channels):
+        for channel in channels:
+            for event in self.events.get(channel, []):
+                event.set()
+
+    async def _listen(self, conn, channels):
+        async with self.lock:
+            async with conn.cursor() as cur:
+                for channel in channels:
+                    await cur.execute(f'LISTEN {channel}')
+
+    async def _listen_new(self, conn, channel):
+        try:
+            await self._listen(conn, [channel])
+        except Exception as e:
+            # on reconnect all channels are listened again
+            self.log.warning(f'Failed to listen {channel}: {e!r}')
+
+    async def _run(self):
+        while True:
+            try:
+                async with aiopg.connect(self.dsn) as conn:
+                    # channels subscribed from now on are listened by subscribe()
+                    self.conn = conn
+                    await self._listen(conn, list(self.events))
+                    self.log.debug(f'Listening {list(self.events)}')
+                    self._wake(self.events)
+                    while True:
+                        channels = {(await conn.notifies.get()).channel}
+                        if self.debounce:
+                            await asyncio.sleep(self.debounce)
+                        while not conn.notifies.empty():
+                            channels.add(conn.notifies.get_nowait().channel)
+                        self._wake(channels)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.log.warning(f'Listener connection is lost: {e!r}')
+            finally:
+                self.conn = None
+            await asyncio.sleep(self.reconnect_delay)
+
 
 class DbRecordsProcessorWorker:
     """
     Asyncio worker which wait for new records in pg db table and process them.
+
+    By default `worker.process_records(conn)` is called on every notification
+    or `max_loop` seconds.
+
+    With `batch_size` records are claimed and processed by the processor itself,
+    several processes can drain the same table without double processing.
+    The worker class should define:
+        claim_query - select with `LIMIT %(limit)s FOR UPDATE SKIP LOCKED`
+        ack_query - update of processed records with `%(ids)s` list
+        async process_record(record) - records are processed concurrently,
+            at most `concurrency` at once; failed records are not acked
+            and are claimed again later
+        id_field - optional, name of records' id, default: 'id'
+
+    Notifications are received by a dedicated `PgNotifyListener` connection,
+    processing starts right after a notification, even if it came during processing.
+
+    Queries of aio_utils helpers made by the worker are recorded to `processor.stats`,
+    see `QueryStats`. With `prepared` claim and ack queries are prepared statements.
     """
 
     MAX_LOOP = 12
 
-    def __init__(self, dsn, worker_class, max_loop=MAX_LOOP):
+    def __init__(
+        self,
+        dsn,
+        worker_class,
+        max_loop=MAX_LOOP,
+        batch_size=None,
+        concurrency=10,
+        listener=None,
+        pool=None,
+        prepared=False,
+    ):
         self.name = worker_class.__name__
         self.log = logging.getLogger(f'processor.{self.name}')
 
         self.dsn = dsn
         self.worker = worker_class(self.log)
         self.max_loop = max_loop
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.listener = listener or PgNotifyListener(dsn, self.log)
+        self.pool = pool
+        self.prepared = prepared
+        self.stats = QueryStats()
+        self.task = None
+        self.loop_timer = None
 
         self.debug('init processor')
         self.loop = asyncio.get_event_loop()
@@ -33,34 +168,95 @@ class DbRecordsProcessorWorker:
 
     async def on_start(self):
         self.debug(f'Starting... {self.dsn}')
-        self.pool = await aiopg.create_pool(self.dsn)
+        if self.pool is None:
+            self.pool = await aiopg.create_pool(self.dsn)
+        self.notified = self.listener.subscribe(self.worker.pg_channel)
+        self.listener.start()
         self.loop_timer = self.loop.call_soon(self.main_loop)
         self.debug('Started')
 
+    async def stop(self):
+        """
+        cancel processing loop, shared pool and listener are left to their owner
+        """
+        if self.loop_timer:
+            self.loop_timer.cancel()
+        if self.task:
+            self.task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.task
+
     def handle_errors(self, fut):
+        if fut.cancelled():
+            return
         if fut.exception():
             self.closed.set_exception(fut.exception())
 
     def main_loop(self):
         self.debug('Main loop')
-        self.loop.create_task(self._inner()).add_done_callback(self.handle_errors)
+        self.task = self.loop.create_task(self._inner())
+        self.task.add_done_callback(self.handle_errors)
 
     async def _inner(self):
-        async with self.pool.acquire() as conn:
-            await self.worker.process_records(conn)
-            try:
-                await asyncio.wait_for(self.notify_wait(conn), self.max_loop)
-            except asyncio.TimeoutError:
-                pass
-        self.loop.call_soon(self.main_loop)
+        # notifications that come during processing set it again
+        self.notified.clear()
+        query_stats.set(self.stats)
+        if self.batch_size:
+            await self.process_batches()
+        else:
+            async with self.pool.acquire() as conn:
+                await self.worker.process_records(conn)
+        try:
+            await asyncio.wait_for(self.notified.wait(), self.max_loop)
+        except asyncio.TimeoutError:
+            pass
+        self.loop_timer = self.loop.call_soon(self.main_loop)
 
-    async def notify_wait(self, conn):
-        async with conn.cursor() as cursor:
-            try:
-                await cursor.execute(f'LISTEN {self.worker.pg_channel}')
-                await asyncio.wait_for(conn.notifies.get(), self.max_loop)
-            except asyncio.TimeoutError:
-                pass
+    async def process_batches(self, conn=None):
+        """
+        claim and process batches while there are full batches and some records succeed
+
+        Without `conn` a pool connection is acquired for every batch, so processors
+        sharing the pool take turns instead of holding connections while draining.
+        """
+        while True:
+            if conn is None:
+                async with self.pool.acquire() as batch_conn:
+                    claimed, acked = await self.process_batch(batch_conn)
+            else:
+                claimed, acked = await self.process_batch(conn)
+            if claimed < self.batch_size or not acked:
+                return
+
+    async def process_batch(self, conn):
+        """
+        returns number of claimed and acked records
+        """
+        id_field = getattr(self.worker, 'id_field', 'id')
+        async with conn.cursor(cursor_factory=DictCursor) as cur:
+            async with cur.begin():
+                await _execute(
+                    cur, self.worker.claim_query, {'limit': self.batch_size}, self.prepared
+                )
+                records = [dict(x) for x in await cur.fetchall()]
+                if not records:
+                    return 0, 0
+                results = await agather_limited(
+                    (self._process_record(record) for record in records), self.concurrency
+                )
+                ids = [record[id_field] for record, ok in zip(records, results) if ok]
+                if ids:
+                    await _execute(cur, self.worker.ack_query, {'ids': ids}, self.prepared)
+        self.debug(f'Processed {len(ids)}/{len(records)} records')
+        return len(records), len(ids)
+
+    async def _process_record(self, record):
+        try:
+            await self.worker.process_record(record)
+            return True
+        except Exception:
+            self.log.exception(f'[{self.name}] Cannot process record: {record}')
+            return False
 
     def run(self):
         def check_error(fut):
@@ -79,12 +275,363 @@ class DbRecordsProcessorWorker:
         loop.run_until_complete(self.closed)
 
 
-async def dict_query(conn, query, params):
-    async with conn.cursor(cursor_factory=DictCursor) as cur:
-        await cur.execute(query, params)
-        return [dict(x) for x in await cur.fetchall()]
+class DbRecordsSupervisor:
+    """
+    Runs several worker classes in one process with shared pool and notifications listener.
+
+    workers - worker classes or (worker_class, processor kwargs) tuples,
+        e.g. `(MarkSent, {'batch_size': 100, 'concurrency': 5})`
+    pool_size - maximum connections of the shared pool
+    processes - number of forked processes, each one runs all workers;
+        exited processes are restarted, SIGTERM/SIGINT are passed to them
+    """
+
+    def __init__(self, dsn, workers, pool_size=10, processes=1, restart_delay=1):
+        self.dsn = dsn
+        self.workers = [w if isinstance(w, tuple) else (w, {}) for w in workers]
+        self.pool_size = pool_size
+        self.processes = processes
+        self.restart_delay = restart_delay
+        self.log = logging.getLogger('processor.supervisor')
+        self.processors = []
+        self.stopping = False
+
+    async def serve(self):
+        """
+        start all processors and wait until one of them fails
+        """
+        pool = await aiopg.create_pool(self.dsn, maxsize=self.pool_size)
+        listener = PgNotifyListener(self.dsn, self.log)
+        self.processors = [
+            DbRecordsProcessorWorker(self.dsn, worker_class, listener=listener, pool=pool, **kwargs)
+            for worker_class, kwargs in self.workers
+        ]
+        try:
+            for processor in self.processors:
+                await processor.on_start()
+            done, _ = await asyncio.wait(
+                [p.closed for p in self.processors], return_when=asyncio.FIRST_COMPLETED
+            )
+            for fut in done:
+                fut.result()
+        finally:
+            for processor in self.processors:
+                await processor.stop()
+            await listener.close()
+            pool.close()
+            await pool.wait_closed()
+
+    def run(self):
+        if self.processes == 1:
+            asyncio.get_event_loop().run_until_complete(self.serve())
+            return
+
+        children = {self._spawn(): i for i in range(self.processes)}
+
+        def stop(signum, frame):
+            self.stopping = True
+            for pid in children:
+                with suppress(ProcessLookupError):
+                    os.kill(pid, signum)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            num = children.pop(pid, None)
+            if num is None or self.stopping:
+                continue
+            self.log.error(f'Process {num} pid={pid} exited: {status}, restarting')
+            time.sleep(self.restart_delay)
+            # stop signal could come during the delay, when there was nobody to pass it to
+            if not self.stopping:
+                children[self._spawn()] = num
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            return pid
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            asyncio.get_event_loop().run_until_complete(self.serve())
+        except BaseException:
+            self.log.exception('Supervised process failed')
+            code = 1
+        finally:
+            os._exit(code)
+
+
+ROW_TYPES = ('dict', 'namedtuple', 'tuple')
+_cursor_ids = itertools.count()
+_PARAM_RE = re.compile(r'%\((\w+)\)s|%s|%%')
+MAX_PREPARED = 256
+# connection => {query: (statement name, parameter keys)}
+_prepared = weakref.WeakKeyDictionary()
+query_stats = ContextVar('query_stats', default=None)
+
+
+class QueryStats:
+    """
+    Latency histograms and row counts by query.
+
+    Set it to `query_stats` context variable and all queries of aio_utils helpers
+    in the context are recorded, `DbRecordsProcessorWorker` does it for its loop.
+    Histogram buckets are powers of two milliseconds: bucket `n` counts queries
+    faster than `2 ** n` ms.
+    """
+
+    BUCKETS = 16
+
+    def __init__(self):
+        # fingerprint => [count, total seconds, rows, histogram]
+        self.queries = {}
 
+    @staticmethod
+    def fingerprint(query):
+        return ' '.join(query.split())
 
-async def sql_update(conn, query, params):
-    async with conn.cursor(cursor_factory=DictCursor) as cur:
+    def record(self, query, seconds, rows):
+        key = self.fingerprint(query)
+        entry = self.queries.get(key)
+        if entry is None:
+            entry = self.queries[key] = [0, 0.0, 0, [0] * self.BUCKETS]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] += max(rows, 0)
+        ms = seconds * 1000
+        bucket = min(math.ceil(math.log2(ms)), self.BUCKETS - 1) if ms > 1 else 0
+        entry[3][bucket] += 1
+
+    def percentile(self, query, q):
+        """
+        upper bound in seconds of the histogram bucket with `q` percentile
+        """
+        count, _, _, histogram = self.queries[self.fingerprint(query)]
+        seen = 0
+        for bucket, num in enumerate(histogram):
+            seen += num
+            if seen >= count * q / 100:
+                return 2**bucket / 1000
+        return 2 ** (self.BUCKETS - 1) / 1000
+
+    def summary(self):
+        """
+        list of dicts with query stats, slowest in total first
+        """
+        return sorted(
+            (
+                {
+                    'query': query,
+                    'count': count,
+                    'total': total,
+                    'mean': total / count,
+                    'p95': self.percentile(query, 95),
+                    'rows': rows,
+                }
+                for query, (count, total, rows, _) in self.queries.items()
+            ),
+            key=lambda x: -x['total'],
+        )
+
+    def clear(self):
+        self.queries.clear()
+
+
+def _prepare_query(query):
+    """
+    convert psycopg2 `%s`/`%(name)s` placeholders to `$n`, returns query and parameter keys
+    """
+    keys = []
+
+    def sub(match):
+        if match.group(0) == '%%':
+            return '%'
+        name = match.group(1)
+        if name is not None and name in keys:
+            return f'${keys.index(name) + 1}'
+        keys.append(len(keys) if name is None else name)
+        return f'${len(keys)}'
+
+    return _PARAM_RE.sub(sub, query), keys
+
+
+async def _execute_prepared(cur, query, params, retry=True):
+    statements = _prepared.setdefault(cur.connection, {})
+    prepared = statements.get(query)
+    if prepared is None:
+        if len(statements) >= MAX_PREPARED:
+            old = next(iter(statements))
+            await cur.execute(f'DEALLOCATE {statements.pop(old)[0]}')
+        converted, keys = _prepare_query(query)
+        name = f'fan_stmt_{next(_cursor_ids)}'
+        await cur.execute(f'PREPARE {name} AS {converted}')
+        prepared = statements[query] = (name, keys)
+    name, keys = prepared
+    args = ' ({})'.format(', '.join(['%s'] * len(keys))) if keys else ''
+    try:
+        await cur.execute(f'EXECUTE {name}{args}', [params[key] for key in keys])
+    except InvalidSqlStatementName:
+        # deallocated behind our back, e.g. by DISCARD ALL
+        statements.clear()
+        # failed transaction can't be continued, only autocommit query is retried
+        idle = cur.connection.raw.get_transaction_status() == TRANSACTION_STATUS_IDLE
+        if not (retry and idle):
+            raise
+        await _execute_prepared(cur, query, params, retry=False)
+
+
+async def _execute(cur, query, params=None, prepared=False):
+    """
+    execute query on aiopg cursor, optionally as cached prepared statement,
+    and record it to `query_stats`
+
+    Prepared statements are cached per connection by query text. Parameter types are
+    inferred by postgres from the query, add casts where they are ambiguous: `%s::int + 1`.
+    Statements deallocated elsewhere, e.g. by `DISCARD ALL`, are prepared again, unless
+    the query runs in a transaction: it's aborted by the error.
+    """
+    stats = query_stats.get()
+    start = time.perf_counter()
+    if prepared:
+        await _execute_prepared(cur, query, params)
+    else:
         await cur.execute(query, params)
+    if stats is not None:
+        stats.record(query, time.perf_counter() - start, cur.rowcount)
+
+
+def _row_maker(description, rows):
+    """
+    returns function which converts a plain tuple row, built once per query
+    """
+    names = [col.name for col in description]
+    if rows == 'namedtuple':
+        return namedtuple('Row', names, rename=True)._make
+    return lambda row: dict(zip(names, row))
+
+
+async def dict_query(conn, query, params, prepared=False):
+    async with conn.cursor() as cur:
+        await _execute(cur, query, params, prepared)
+        make = _row_maker(cur.description, 'dict')
+        return [make(x) for x in await cur.fetchall()]
+
+
+async def dict_query_one(conn, query, params, prepared=False):
+    """
+    returns first row as dict or None
+    """
+    async with conn.cursor() as cur:
+        await _execute(cur, query, params, prepared)
+        row = await cur.fetchone()
+        if row is None:
+            return None
+        return _row_maker(cur.description, 'dict')(row)
+
+
+async def scalar(conn, query, params, default=None, prepared=False):
+    """
+    returns first column of the first row or `default` when there are no rows
+    """
+    async with conn.cursor() as cur:
+        await _execute(cur, query, params, prepared)
+        row = await cur.fetchone()
+        return default if row is None else row[0]
+
+
+async def dict_stream(conn, query, params, itersize=2000, rows='dict', batches=False):
+    """
+    async generator over the query result, fetched by server-side cursor
+
+    Only `itersize` rows are in memory at once. The cursor lives in a transaction on
+    `conn`, so don't use the connection for other queries until the stream is exhausted
+    or closed, use `contextlib.aclosing` when breaking out of the loop.
+
+    rows - 'dict', 'namedtuple' or 'tuple'
+    batches - yield lists of up to `itersize` rows instead of single rows
+    """
+    if rows not in ROW_TYPES:
+        raise ValueError(f'rows must be one of {ROW_TYPES}')
+    name = f'dict_stream_{next(_cursor_ids)}'
+    stats = query_stats.get()
+    async with conn.cursor() as cur:
+        async with cur.begin():
+            await cur.execute(f'DECLARE {name} NO SCROLL CURSOR FOR {query}', params)
+            make = None
+            while True:
+                start = time.perf_counter()
+                await cur.execute(f'FETCH {int(itersize)} FROM {name}')
+                chunk = await cur.fetchall()
+                if stats is not None:
+                    stats.record(query, time.perf_counter() - start, len(chunk))
+                if not chunk:
+                    break
+                if rows != 'tuple':
+                    make = make or _row_maker(cur.description, rows)
+                    chunk = [make(row) for row in chunk]
+                if batches:
+                    yield chunk
+                else:
+                    for row in chunk:
+                        yield row
+                if len(chunk) < itersize:
+                    break
+
+
+async def sql_update(conn, query, params, prepared=False):
+    async with conn.cursor() as cur:
+        await _execute(cur, query, params, prepared)
+
+
+async def sql_bulk_update(conn, query, rows, template=None, max_params=10000, atomic=True):
+    """
+    execute `query` with many rows joined into multi-row VALUES, returns affected rows per chunk
+
+    query - statement with single `%s` placeholder for the VALUES list, e.g.
+        UPDATE records SET processed = v.processed FROM (VALUES %s) AS v(id, processed)
+        WHERE records.id = v.id
+    rows - sequences or, with named `template`, mappings
+    template - row template, default `(%s, %s, ...)` by the first row's length
+    max_params - rows are split into statements with at most this number of parameters
+    atomic - execute all chunks in one transaction
+    """
+    rows = list(rows)
+    if not rows:
+        return []
+    if query.count('%s') != 1:
+        raise ValueError('query must have single %s placeholder for VALUES')
+    prefix, suffix = (part.replace('%%', '%').encode() for part in query.split('%s'))
+    width = len(rows[0])
+    template = template or '({})'.format(', '.join(['%s'] * width))
+    size = max(1, max_params // max(width, 1))
+    stats = query_stats.get()
+
+    counts = []
+    async with conn.cursor() as cur:
+        async with cur.begin() if atomic else nullcontext():
+            for start in range(0, len(rows), size):
+                values = b','.join(cur.mogrify(template, row) for row in rows[start : start + size])
+                began = time.perf_counter()
+                await cur.execute(prefix + values + suffix)
+                if stats is not None:
+                    stats.record(query, time.perf_counter() - began, cur.rowcount)
+                counts.append(cur.rowcount)
+    return counts
+
+
+async def sql_bulk_insert(conn, table, columns, rows, suffix='', **kwargs):
+    """
+    insert rows with multi-row VALUES statements, returns inserted rows per chunk
+
+    suffix - e.g. `ON CONFLICT DO NOTHING`
+    kwargs - passed to `sql_bulk_update`
+    """
+    query = f'INSERT INTO {table} ({", ".join(columns)}) VALUES %s {suffix}'
+    return await sql_bulk_update(conn, query, rows, **kwargs)
+
@@ -1,8 +1,20 @@
+import copy
+import datetime
+import json
 import logging.config
+import logging.handlers
 import os
+import queue
+import random
 import sys
+import threading
+import time
+import traceback
+from inspect import istraceback
 
-from pythonjsonlogger.jsonlogger import JsonFormatter
+from pythonjsonlogger.jsonlogger import JsonFormatter, RESERVED_ATTRS
+
+from fan_tools.python import TokenBucket
 
 
 class JSFormatter(JsonFormatter):
@@ -42,6 +54,313 @@ class JSFormatter(JsonFormatter):
         return rec
 
 
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records to a bounded queue, handlers are called by `listener` thread.
+
+    policy:
+    'drop' - records are dropped when the queue is full
+    'block' - caller waits for free space, up to `block_timeout` seconds, then drops
+
+    Dropped records are counted in `dropped`. `get_context` is called in the caller
+    thread, its result is added to the record.
+    """
+
+    def __init__(self, queue, policy='drop', block_timeout=None, get_context=None):
+        assert policy in ('drop', 'block'), f'Unknown policy: {policy}'
+        super().__init__(queue)
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.get_context = get_context
+        self.dropped = 0
+        self.listener = None
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record):
+        # other handlers of the logger get the record untouched, like in the base class;
+        # args may change before formatting in the listener thread, so str templates are
+        # merged now, dict messages are kept for json formatters;
+        # unlike the base class exc_info is kept, records don't leave the process
+        record = copy.copy(record)
+        if isinstance(record.msg, str) and record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        if self.get_context:
+            record.__dict__.update(self.get_context())
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.policy == 'block':
+                self.queue.put(record, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def start(self, *handlers):
+        self.listener = logging.handlers.QueueListener(
+            self.queue, *handlers, respect_handler_level=True
+        )
+        self.listener.start()
+
+    def close(self):
+        # logging.shutdown closes it before target handlers, so queued records are written
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+        super().close()
+
+
+def install_queue_handler(logger, queue_size=10000, policy='drop', get_context=None):
+    """
+    move handlers of the logger behind QueueHandler, returns the QueueHandler
+    """
+    handlers = logger.handlers[:]
+    for handler in handlers:
+        logger.removeHandler(handler)
+    handler = QueueHandler(queue.Queue(queue_size), policy, get_context=get_context)
+    handler.start(*handlers)
+    logger.addHandler(handler)
+    return handler
+
+
+def json_default(obj):
+    """
+    same as python-json-logger default: dates in ISO format, str() for the rest
+    """
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    elif istraceback(obj):
+        return ''.join(traceback.format_tb(obj)).strip()
+    elif isinstance(obj, Exception):
+        return 'Exception: %s' % str(obj)
+    return str(obj)
+
+
+def _stdlib_dumps(rec):
+    return json.dumps(rec, default=json_default)
+
+
+def get_json_dumps(encoder='auto'):
+    """
+    encoder: 'orjson', 'ujson', 'json' or 'auto' for the fastest installed one
+    returns function: dict -> str
+
+    Output is the same as of JSFormatter, except for types that orjson serializes natively:
+    Enum members become their values (`1` instead of `'Color.RED'`), NaN and infinity
+    become `null` instead of invalid JSON `NaN`/`Infinity`.
+    """
+    if encoder in ('auto', 'orjson'):
+        try:
+            import orjson
+        except ImportError:
+            if encoder == 'orjson':
+                raise
+        else:
+            # dataclasses go to json_default, like with json module
+            option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATACLASS
+
+            def orjson_dumps(rec):
+                try:
+                    return orjson.dumps(rec, default=json_default, option=option).decode()
+                except TypeError:
+                    # e.g. integers over 64 bits
+                    return _stdlib_dumps(rec)
+
+            return orjson_dumps
+    if encoder in ('auto', 'ujson'):
+        try:
+            import ujson
+        except ImportError:
+            if encoder == 'ujson':
+                raise
+        else:
+
+            def ujson_dumps(rec):
+                try:
+                    return ujson.dumps(rec, default=json_default)
+                except (TypeError, OverflowError):
+                    return _stdlib_dumps(rec)
+
+            return ujson_dumps
+    if encoder not in ('auto', 'json'):
+        raise ValueError(f'Unknown json encoder: {encoder}')
+    return _stdlib_dumps
+
+
+class FastJSFormatter(logging.Formatter):
+    """
+    JSFormatter records without python-json-logger overhead.
+
+    Record fields to extract are computed once, `asctime` is formatted only when it is
+    not dropped. Output is serialized by orjson or ujson when installed, orjson encodes
+    enums and NaN differently, see `get_json_dumps`.
+
+    drop_fields - record fields that are not needed in the output, e.g. ['relativeCreated']
+    json_encoder - 'auto', 'orjson', 'ujson' or 'json'
+    """
+
+    msg_keys = JSFormatter.msg_keys
+
+    def __init__(
+        self,
+        *args,
+        env_vars=[],
+        get_context=None,
+        drop_fields=[],
+        json_encoder='auto',
+        prefix='',
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.default_keys = {k: v for k, v in list(os.environ.items()) if k in env_vars}
+        self.get_context_function = get_context
+        self.prefix = prefix
+        self.dumps = get_json_dumps(json_encoder)
+        fields = [f for f in self.msg_keys if f not in drop_fields]
+        if self._fmt:
+            fields.extend(f for f in self.parse_fields(self._fmt) if f not in fields + drop_fields)
+        self.fields = tuple(fields)
+        self.with_asctime = 'asctime' in self.fields
+        self.skip_fields = frozenset(RESERVED_ATTRS) | frozenset(self.fields) | set(drop_fields)
+
+    @staticmethod
+    def parse_fields(fmt):
+        return [x.split(')')[0] for x in fmt.split('%(')[1:]]
+
+    def format(self, record):
+        message_dict = None
+        if isinstance(record.msg, dict):
+            message_dict = record.msg
+            record.message = None
+        else:
+            record.message = record.getMessage()
+        if self.with_asctime:
+            record.asctime = self.formatTime(record, self.datefmt)
+
+        data = record.__dict__
+        rec = {field: data.get(field) for field in self.fields}
+        if message_dict:
+            rec.update(message_dict)
+        if record.exc_info and not rec.get('exc_info'):
+            rec['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text and not rec.get('exc_info'):
+            rec['exc_info'] = record.exc_text
+        skip = self.skip_fields
+        for key, value in data.items():
+            if key not in skip and not (isinstance(key, str) and key.startswith('_')):
+                rec[key] = value
+        rec = self.process_log_record(rec)
+        return self.prefix + self.dumps(rec)
+
+    def process_log_record(self, rec):
+        if self.default_keys:
+            rec.update(self.default_keys)
+        if self.get_context_function:
+            rec.update(self.get_context_function())
+        return rec
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Rate limits records by (logger, level, message template) with token buckets.
+
+    rate, burst - records per second and burst size for every key
+    sample - pass only this fraction of records, e.g. 0.1, the rest are suppressed
+    error_rate, error_burst - limits for ERROR and above, by default they are never limited
+    summary_interval - 'Suppressed N similar records' are logged by a timer thread
+        at most once per this interval, in seconds
+    max_keys - buckets are reset when there are more keys, e.g. for formatted messages
+
+    The decision is stored on the record, so one instance shared by several handlers
+    handles every record once. Dict messages, e.g. `send_metric` records, are never
+    limited: metrics are counters, a dropped record would corrupt them.
+    """
+
+    def __init__(
+        self,
+        rate=10,
+        burst=50,
+        sample=None,
+        error_rate=None,
+        error_burst=None,
+        summary_interval=60,
+        max_keys=10000,
+        name='',
+    ):
+        super().__init__(name)
+        self.rate = rate
+        self.burst = burst
+        self.sample = sample
+        self.error_rate = error_rate
+        self.error_burst = error_burst or error_rate
+        self.summary_interval = summary_interval
+        self.max_keys = max_keys
+        self.attr = f'_rate_limit_{id(self)}'
+        self.buckets = {}
+        self.suppressed = {}
+        self.lock = threading.Lock()
+        self.next_summary = time.monotonic() + summary_interval
+        self.timer = None
+
+    def filter(self, record):
+        passed = record.__dict__.get(self.attr)
+        if passed is None:
+            passed = self.decide(record)
+            setattr(record, self.attr, passed)
+        return passed
+
+    def decide(self, record):
+        error = record.levelno >= logging.ERROR
+        if (error and self.error_rate is None) or isinstance(record.msg, dict):
+            return True
+        msg = record.msg if isinstance(record.msg, str) else type(record.msg).__name__
+        key = (record.name, record.levelno, msg)
+        with self.lock:
+            if not error and self.sample is not None and random.random() >= self.sample:
+                passed = False
+            else:
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    if len(self.buckets) >= self.max_keys:
+                        self.buckets.clear()
+                    bucket = self.buckets[key] = (
+                        TokenBucket(self.error_rate, self.error_burst)
+                        if error
+                        else TokenBucket(self.rate, self.burst)
+                    )
+                passed = bucket.consume()
+            if not passed:
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                if self.timer is None:
+                    delay = max(self.next_summary - time.monotonic(), 0)
+                    self.timer = threading.Timer(delay, self.log_summary)
+                    self.timer.daemon = True
+                    self.timer.start()
+        return passed
+
+    def log_summary(self):
+        """
+        log and reset counters of suppressed records
+        """
+        with self.lock:
+            suppressed, self.suppressed = self.suppressed, {}
+            self.next_summary = time.monotonic() + self.summary_interval
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+        for (name, levelno, msg), count in suppressed.items():
+            logging.getLogger(name).log(
+                levelno,
+                'Suppressed %s similar records: %s',
+                count,
+                msg,
+                extra={self.attr: True, 'suppressed': count},
+            )
+
+
 def base_handler(filename, **params):
     return {
         'level': 'DEBUG',
@@ -76,10 +395,21 @@ def setup_logger(
     stdout_level='DEBUG',
     handlers={},
     json_params={},
+    enable_queue=False,
+    queue_size=10000,
+    queue_policy='drop',
+    rate_limit=None,
 ):
     """
     json_formatter:
     'fan.contrib.django.span_formatter.SpanFormatter' - add INSTALLATION_ID, SPAN and etc
+
+    enable_queue: root handlers are called from a separate thread, logging calls only
+    put records to a queue with `queue_size` limit, see `QueueHandler` for `queue_policy`.
+    Returns the QueueHandler, its `dropped` attribute counts dropped records.
+
+    rate_limit: `RateLimitFilter` params, e.g. {'rate': 5, 'burst': 100}, the filter
+    is added to all root handlers, or to the QueueHandler with enable_queue.
     """
     if not root_dir:
         root_dir = os.environ.get('LOG_DIR')
@@ -90,6 +420,8 @@ def setup_logger(
         'env_vars': ['HOST_TYPE', 'DEPLOYMENT_CONFIG', 'DEPLOYMENT_BRANCH', 'CONTAINER_TYPE'],
         **json_params,
     }
+    # context belongs to the thread which logs
+    get_context = JSON_FORMATTER.pop('get_context', None) if enable_queue else None
 
     default_loggers = {
         '': {'handlers': ['default'], 'level': 'DEBUG', 'propagate': True},
@@ -129,8 +461,26 @@ def setup_logger(
             'formatter': 'standard',
         }
         LOGGING['loggers']['']['handlers'].append('stdout')
+
+    if rate_limit is not None and not enable_queue:
+        LOGGING['filters'] = {
+            'rate_limit': {'()': 'fan_tools.fan_logging.RateLimitFilter', **rate_limit}
+        }
+        for handler_name in LOGGING['loggers']['']['handlers']:
+            handler = LOGGING['handlers'][handler_name] = {**LOGGING['handlers'][handler_name]}
+            handler['filters'] = [*handler.get('filters', []), 'rate_limit']
     logging.config.dictConfig(LOGGING)
 
+    if enable_queue:
+        handler = install_queue_handler(
+            logging.getLogger(), queue_size, queue_policy, get_context=get_context
+        )
+        if rate_limit is not None:
+            # before the record is queued: suppressed records aren't enqueued and
+            # message templates aren't merged with args yet
+            handler.addFilter(RateLimitFilter(**rate_limit))
+        return handler
+
 
 def setup_fan_logger(base_name, root_dir=None):
     return setup_logger(
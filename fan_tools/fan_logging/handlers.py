@@ -1,5 +1,8 @@
 import logging
 import socket
+import threading
+import time
+from collections import deque
 from logging import Handler
 from logging.handlers import SYSLOG_UDP_PORT
 
@@ -24,8 +27,44 @@ Usage:
         }}
     )
 
+With `batch=True` records are sent by a background thread: frames are accumulated up to
+`batch_bytes` or `flush_interval` seconds and written with one `sendmsg` call on stream
+sockets, using RFC 6587 octet-counting framing. While the server is unavailable frames are
+kept in memory, up to `spill_records`, older frames are dropped and counted in `dropped`.
+
+Network addresses are resolved once per `resolve_ttl` seconds, the destination of
+datagrams is refreshed by a background thread when it expires. Reconnects are made by
+a background thread with exponential backoff from `reconnect_delay` to
+`max_reconnect_delay` seconds; without batching records emitted meanwhile are kept in
+the same bounded buffer and replayed after reconnect.
+
 """
 
+IOV_MAX = 1024
+# frames replayed after reconnect at once, emit is blocked meanwhile
+REPLAY_SLICE = 100
+# (host, port, socktype) => (expires_at, getaddrinfo result)
+_addrinfo_cache = {}
+
+
+def getaddrinfo_cached(host, port, socktype, ttl):
+    """
+    socket.getaddrinfo cached for `ttl` seconds, a stale result is used while resolving fails
+    """
+    key = (host, port, socktype)
+    cached = _addrinfo_cache.get(key)
+    now = time.monotonic()
+    if cached and cached[0] > now:
+        return cached[1]
+    try:
+        ress = socket.getaddrinfo(host, port, 0, socktype)
+    except OSError:
+        if cached:
+            return cached[1]
+        raise
+    _addrinfo_cache[key] = (now + ttl, ress)
+    return ress
+
 class SysLogHandler(logging.Handler):
     """
     A handler class which sends formatted logging records to a syslog
@@ -137,7 +176,9 @@ class SysLogHandler(logging.Handler):
     }
 
     def __init__(self, address=('localhost', SYSLOG_UDP_PORT),
-                 facility=LOG_USER, socktype=None):
+                 facility=LOG_USER, socktype=None, batch=False, batch_bytes=64 * 1024,
+                 flush_interval=0.05, spill_records=10000, reconnect_delay=1,
+                 max_reconnect_delay=30, resolve_ttl=60):
         """
         Initialize a handler.
 
@@ -155,7 +196,34 @@ class SysLogHandler(logging.Handler):
         self.facility = facility
         self.socktype = socktype
         self.socket = None
-        self.createSocket()
+        self.sockaddr = None
+        self.batch = batch
+        self.spill_records = spill_records
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.resolve_ttl = resolve_ttl
+        self.resolve_at = float('inf')
+        self.resolving = False
+        self.dropped = 0
+        self.frames = deque()
+        self.buffered = 0
+        self.closing = False
+        self.cond = threading.Condition()
+        if not batch:
+            self.reconnecting = False
+            try:
+                self.createSocket()
+            except OSError:
+                self.startReconnect()
+            return
+
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.in_flight = False
+        self.flushing = False
+        self.failures = 0
+        self.sender = threading.Thread(target=self._send_loop, name='SysLogHandler', daemon=True)
+        self.sender.start()
 
     def _connect_unixsocket(self, address):
         use_socktype = self.socktype
@@ -200,7 +268,8 @@ class SysLogHandler(logging.Handler):
             if socktype is None:
                 socktype = socket.SOCK_DGRAM
             host, port = self.address
-            ress = socket.getaddrinfo(host, port, 0, socktype)
+            cache_key = (host, port, socktype)
+            ress = getaddrinfo_cached(host, port, socktype, self.resolve_ttl)
             if not ress:
                 raise OSError("getaddrinfo returns an empty list")
 
@@ -217,9 +286,13 @@ class SysLogHandler(logging.Handler):
                     if sock is not None:
                         sock.close()
             if err is not None:
+                # the address could change, resolve it again next time
+                _addrinfo_cache.pop(cache_key, None)
                 raise err
             self.socket = sock
             self.socktype = socktype
+            self.sockaddr = sa
+            self.resolve_at = time.monotonic() + self.resolve_ttl
 
     def encodePriority(self, facility, priority):
         """
@@ -238,6 +311,12 @@ class SysLogHandler(logging.Handler):
         """
         Closes the socket.
         """
+        if self.batch:
+            self.closeBatched()
+        else:
+            with self.cond:
+                self.closing = True
+                self.cond.notify_all()
         self.acquire()
         try:
             sock = self.socket
@@ -261,6 +340,22 @@ class SysLogHandler(logging.Handler):
     ident = ''          # prepended to all messages
     append_nul = True   # some old syslog daemons expect a NUL terminator
 
+    def buildMessage(self, record, append_nul):
+        msg = self.format(record)
+        if self.ident:
+            msg = self.ident + msg
+        if append_nul:
+            msg += '\000'
+
+        # We need to convert record level to lowercase, maybe this will
+        # change in the future.
+        prio = '<%d>' % self.encodePriority(self.facility,
+                                            self.mapPriority(record.levelname))
+        prio = prio.encode('utf-8')
+        # Message is a string. Convert to bytes as required by RFC 5424
+        msg = msg.encode('utf-8')
+        return prio + msg
+
     def emit(self, record):
         """
         Emit a record.
@@ -268,35 +363,247 @@ class SysLogHandler(logging.Handler):
         The record is formatted, and then sent to the syslog server. If
         exception information is present, it is NOT sent to the server.
         """
+        if self.batch:
+            return self.emitBatched(record)
         try:
-            msg = self.format(record)
-            if self.ident:
-                msg = self.ident + msg
-            if self.append_nul:
-                msg += '\000'
-
-            # We need to convert record level to lowercase, maybe this will
-            # change in the future.
-            prio = '<%d>' % self.encodePriority(self.facility,
-                                                self.mapPriority(record.levelname))
-            prio = prio.encode('utf-8')
-            # Message is a string. Convert to bytes as required by RFC 5424
-            msg = msg.encode('utf-8')
-            msg = prio + msg
-
-            if not self.socket:
-                self.createSocket()
+            msg = self.buildMessage(record, self.append_nul)
 
             if self.unixsocket:
+                if not self.socket:
+                    self.createSocket()
                 try:
                     self.socket.send(msg)
                 except OSError:
                     self.socket.close()
                     self._connect_unixsocket(self.address)
                     self.socket.send(msg)
-            elif self.socktype == socket.SOCK_DGRAM:
-                self.socket.sendto(msg, self.address)
+            elif self.reconnecting:
+                self.spill(msg)
             else:
-                self.socket.sendall(msg)
+                try:
+                    self.sendMessage(msg)
+                except OSError:
+                    self._closeSocket()
+                    self.spill(msg)
+                    self.startReconnect()
         except Exception:
             self.handleError(record)
+
+    def sendMessage(self, msg):
+        if self.socktype == socket.SOCK_DGRAM:
+            if not self.resolving and time.monotonic() >= self.resolve_at:
+                # the old address is used until it's resolved, emit doesn't wait for DNS
+                self.resolving = True
+                threading.Thread(
+                    target=self._resolveSockaddr, name='SysLogHandler', daemon=True
+                ).start()
+            self.socket.sendto(msg, self.sockaddr)
+        else:
+            self.socket.sendall(msg)
+
+    def spill(self, msg):
+        with self.cond:
+            self.frames.append(msg)
+            self.buffered += len(msg)
+            self._trimFrames()
+
+    def _resolveSockaddr(self):
+        """
+        refresh the destination of datagrams, sendto a stale address doesn't fail
+        """
+        try:
+            host, port = self.address
+            sock = self.socket
+            for af, _, _, _, sa in getaddrinfo_cached(host, port, self.socktype, self.resolve_ttl):
+                if sock and af == sock.family:
+                    self.sockaddr = sa
+                    break
+        except OSError:
+            pass
+        finally:
+            self.resolve_at = time.monotonic() + self.resolve_ttl
+            self.resolving = False
+
+    def startReconnect(self):
+        self.reconnecting = True
+        threading.Thread(target=self._reconnect_loop, name='SysLogHandler', daemon=True).start()
+
+    def backoff(self, failures):
+        return min(self.reconnect_delay * 2 ** (failures - 1), self.max_reconnect_delay)
+
+    def _reconnect_loop(self):
+        failures = 0
+        while True:
+            if failures:
+                with self.cond:
+                    if self.cond.wait_for(lambda: self.closing, self.backoff(failures)):
+                        return
+            failures += 1
+            try:
+                self.createSocket()
+            except OSError:
+                continue
+            # records emitted while buffered ones are replayed are spilled, so the order
+            # is kept; emit waits only for the current slice
+            if self._replay():
+                return
+
+    def _replay(self):
+        """
+        send spilled frames, returns False on send error
+        """
+        while True:
+            self.acquire()
+            try:
+                for _ in range(REPLAY_SLICE):
+                    with self.cond:
+                        if self.closing:
+                            return True
+                        if not self.frames:
+                            self.reconnecting = False
+                            return True
+                        frame = self.frames.popleft()
+                        self.buffered -= len(frame)
+                    try:
+                        self.sendMessage(frame)
+                    except OSError:
+                        with self.cond:
+                            self.frames.appendleft(frame)
+                            self.buffered += len(frame)
+                            self._trimFrames()
+                        self._closeSocket()
+                        return False
+            finally:
+                self.release()
+
+    def emitBatched(self, record):
+        try:
+            # NUL is added by the sender for datagrams, stream frames are octet-counted
+            frame = self.buildMessage(record, False)
+        except Exception:
+            self.handleError(record)
+            return
+        with self.cond:
+            self.frames.append(frame)
+            self.buffered += len(frame)
+            self._trimFrames()
+            if len(self.frames) == 1 or self.buffered >= self.batch_bytes:
+                self.cond.notify_all()
+
+    def _trimFrames(self):
+        while len(self.frames) > self.spill_records:
+            self.buffered -= len(self.frames.popleft())
+            self.dropped += 1
+
+    def _connect(self):
+        if isinstance(self.address, str):
+            self.unixsocket = True
+            self._connect_unixsocket(self.address)
+        else:
+            self.createSocket()
+
+    def _closeSocket(self):
+        sock, self.socket = self.socket, None
+        if sock:
+            sock.close()
+
+    def _send_loop(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.frames or self.closing)
+                if not self.closing and not self.flushing and self.buffered < self.batch_bytes:
+                    # the first frame wakes us up, wait for more to fill the batch
+                    self.cond.wait_for(
+                        lambda: self.buffered >= self.batch_bytes or self.flushing or self.closing,
+                        self.flush_interval,
+                    )
+                frames = list(self.frames)
+                self.frames.clear()
+                self.buffered = 0
+                self.in_flight = bool(frames)
+            if not frames:
+                return
+
+            sent = self._sendFrames(frames)
+
+            with self.cond:
+                unsent = frames[sent:]
+                if unsent:
+                    # keep order: unsent frames go before the ones emitted meanwhile
+                    self.frames.extendleft(reversed(unsent))
+                    self.buffered += sum(len(f) for f in unsent)
+                    self._trimFrames()
+                self.in_flight = False
+                self.cond.notify_all()
+                if not unsent:
+                    self.failures = 0
+                    continue
+                if self.closing:
+                    return
+                self.failures += 1
+                self.cond.wait_for(lambda: self.closing, self.backoff(self.failures))
+
+    def _sendFrames(self, frames):
+        """
+        returns number of completely sent frames, it is less than len(frames) on errors
+        """
+        sent = 0
+        try:
+            if self.socket and self.socktype == socket.SOCK_STREAM and self._peerClosed():
+                self._closeSocket()
+            if not self.socket:
+                self._connect()
+            if self.socktype == socket.SOCK_STREAM:
+                chunk = [b'%d %b' % (len(f), f) for f in frames]
+                while sent < len(chunk):
+                    written = self.socket.sendmsg(chunk[sent:sent + IOV_MAX])
+                    while sent < len(chunk) and written >= len(chunk[sent]):
+                        written -= len(chunk[sent])
+                        sent += 1
+                    if written:
+                        # partial write, the rest of the frame goes first
+                        chunk[sent] = chunk[sent][written:]
+            else:
+                nul = b'\000' if self.append_nul else b''
+                if not self.unixsocket and time.monotonic() >= self.resolve_at:
+                    self._resolveSockaddr()
+                for frame in frames:
+                    if self.unixsocket:
+                        self.socket.send(frame + nul)
+                    else:
+                        self.socket.sendto(frame + nul, self.sockaddr)
+                    sent += 1
+        except OSError:
+            # partially written frame is sent again over the new connection
+            self._closeSocket()
+        return sent
+
+    def _peerClosed(self):
+        """
+        write to a closed connection succeeds once and the data is lost, check it in advance
+        """
+        try:
+            return self.socket.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+
+    def flush(self, timeout=1):
+        """
+        wait until buffered frames are sent, at most `timeout` seconds
+        """
+        if not self.batch or self.closing:
+            return
+        with self.cond:
+            self.flushing = True
+            self.cond.notify_all()
+            self.cond.wait_for(lambda: not self.frames and not self.in_flight, timeout)
+            self.flushing = False
+
+    def closeBatched(self):
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        self.sender.join(self.flush_interval + 1)
+        self._closeSocket()
@@ -1,33 +1,160 @@
+import asyncio
+import functools
 import itertools
+import marshal
 import os
+import struct
 import sys
 import warnings
 import zipfile
-from decimal import Decimal, ROUND_HALF_UP
+from collections import deque
+from decimal import Context, Decimal, localcontext, ROUND_HALF_UP
+from importlib.util import MAGIC_NUMBER
+from numbers import Integral
 from pathlib import Path
-from typing import Any, BinaryIO, Dict, Iterable, List, Optional, Sequence, Union
-
-from .decorators import cache_async, memoize, retry  # pyright: ignore # noqa: F401
-
-
-def execfile(fname: Union[str, Path], _globals: Dict[str, Any], _locals: Dict[str, Any]):
+from types import CodeType
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    BinaryIO,
+    Callable,
+    cast,
+    Deque,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+from .cache import atomic_write
+from .decorators import (  # pyright: ignore # noqa: F401
+    cache_async,
+    CircuitBreaker,
+    CircuitOpenError,
+    memoize,
+    retry,
+    TokenBucket,
+)
+
+
+# absolute path => (mtime_ns, size, code, persisted)
+_code_cache: Dict[str, Tuple[int, int, CodeType, bool]] = {}
+_code_header = struct.Struct('<qq')
+
+
+def _compile_file(fname: Union[str, Path]) -> CodeType:
+    with open(fname) as f:
+        return compile(f.read(), os.path.basename(fname), 'exec')
+
+
+def _persisted_code_path(path: str) -> Path:
+    pth = Path(path)
+    return pth.parent / '__pycache__' / f'{pth.name}.{sys.implementation.cache_tag}.execfile'
+
+
+def _load_persisted_code(path: str, mtime_ns: int, size: int) -> Optional[CodeType]:
+    try:
+        data = _persisted_code_path(path).read_bytes()
+    except OSError:
+        return None
+    magic_size = len(MAGIC_NUMBER)
+    if len(data) < magic_size + _code_header.size or data[:magic_size] != MAGIC_NUMBER:
+        return None
+    if _code_header.unpack_from(data, magic_size) != (mtime_ns, size):
+        return None
+    try:
+        return marshal.loads(data[magic_size + _code_header.size :])
+    except (EOFError, ValueError, TypeError):
+        return None
+
+
+def _persist_code(path: str, mtime_ns: int, size: int, code: CodeType):
+    pth = _persisted_code_path(path)
+    data = MAGIC_NUMBER + _code_header.pack(mtime_ns, size) + marshal.dumps(code)
+    try:
+        pth.parent.mkdir(exist_ok=True)
+        atomic_write(pth, data)
+    except OSError:
+        # read-only location, in-memory cache still works
+        pass
+
+
+def _cached_code(fname: Union[str, Path], persist: bool) -> CodeType:
+    path = os.path.abspath(fname)
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _code_cache.get(path)
+    if cached and cached[:2] == stamp:
+        code, persisted = cached[2:]
+        if persist and not persisted:
+            _persist_code(path, *stamp, code)
+            _code_cache[path] = (*stamp, code, True)
+        return code
+    code = _load_persisted_code(path, *stamp) if persist else None
+    if code is None:
+        code = _compile_file(fname)
+        if persist:
+            _persist_code(path, *stamp, code)
+    _code_cache[path] = (*stamp, code, persist)
+    return code
+
+
+def execfile(
+    fname: Union[str, Path],
+    _globals: Dict[str, Any],
+    _locals: Dict[str, Any],
+    cache: bool = False,
+    persist: bool = False,
+):
     """
     Usage: execfile('path/to/file.py', globals(), locals())
+
+    cache=True - reuse compiled code while file's mtime and size don't change
+    persist=True - also keep compiled code in `__pycache__` next to the file
+    for other processes
     """
     if os.path.exists(fname):
-        with open(fname) as f:
-            code = compile(f.read(), os.path.basename(fname), 'exec')
-            exec(code, _globals, _locals)
-            return True
+        if cache or persist:
+            code = _cached_code(fname, persist)
+        else:
+            code = _compile_file(fname)
+        exec(code, _globals, _locals)
+        return True
     else:
         return False
 
 
+@functools.lru_cache(maxsize=1024)
+def _resolve_rel_path(caller: str, path: str, cwd: Optional[str]) -> Path:
+    return (Path(caller).parent / path).resolve()
+
+
+# paths checked by rel_path and directories created by auto_directory in this process
+_existing_paths: Set[Path] = set()
+_created_directories: Set[Path] = set()
+
+
 def rel_path(path: str, check: bool = False, depth: int = 1) -> Path:
-    d = Path(sys._getframe(depth).f_code.co_filename).parent
-    full = (d / path).resolve()
-    if check and not full.exists():
-        raise Exception('No such path: {!r}'.format(full))
+    """
+    path relative to the caller's file, resolved paths and successful checks are cached
+    """
+    caller = sys._getframe(depth).f_code.co_filename
+    # relative caller's file name depends on the current directory
+    cwd = None if os.path.isabs(caller) else os.getcwd()
+    full = _resolve_rel_path(caller, path, cwd)
+    if check and full not in _existing_paths:
+        if not full.exists():
+            raise Exception('No such path: {!r}'.format(full))
+        _existing_paths.add(full)
     return full
 
 
@@ -41,69 +168,323 @@ def auto_directory(path: Union[str, Path]) -> Path:
     """
     if you're using py.path you make do that as:
     py.path.local(full_path).ensure_dir()
+
+    directory is created once per process
     """
     if isinstance(path, str):
         dir_path = rel_path(path, depth=2)
     else:
         dir_path = path
-    dir_path.mkdir(exist_ok=True, parents=True)
+    if dir_path not in _created_directories:
+        dir_path.mkdir(exist_ok=True, parents=True)
+        _created_directories.add(dir_path)
     return dir_path
 
 
+CENT = Decimal('.01')
+# exact sums of long ledgers, rounding happens once at the end
+_sum_context = Context(prec=100, rounding=ROUND_HALF_UP)
+Amount = Union[str, Decimal, int]
+
+
 def usd_round(amount: Union[str, Decimal]) -> Decimal:
     if isinstance(amount, str):
         amount = Decimal(amount)
-    return amount.quantize(Decimal('.01'), rounding=ROUND_HALF_UP)
+    return amount.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def _to_decimal(amount: Amount) -> Decimal:
+    """
+    integers are cents
+    """
+    if isinstance(amount, Decimal):
+        return amount
+    if isinstance(amount, str):
+        return Decimal(amount)
+    if isinstance(amount, Integral):
+        return Decimal(int(amount)).scaleb(-2)
+    raise TypeError(f'Unsupported amount: {amount!r}')
+
+
+def usd_round_many(amounts: Iterable[Amount], cents: bool = False) -> List[Any]:
+    """
+    round many amounts: str and Decimal are dollars, integers (including numpy) are cents
+
+    cents=True - return integer cents instead of Decimal
+
+    $ usd_round_many(['1.005', Decimal('2.994'), 150])
+    # => [Decimal('1.01'), Decimal('2.99'), Decimal('1.50')]
+    $ usd_round_many(['1.005', 150], cents=True) # => [101, 150]
+    """
+    quantize = Decimal.quantize
+    out = []
+    for amount in amounts:
+        if not isinstance(amount, Decimal):
+            if isinstance(amount, str):
+                amount = Decimal(amount)
+            elif isinstance(amount, Integral):
+                # already whole cents
+                out.append(int(amount) if cents else Decimal(int(amount)).scaleb(-2))
+                continue
+            else:
+                raise TypeError(f'Unsupported amount: {amount!r}')
+        rounded = quantize(amount, CENT, ROUND_HALF_UP)
+        out.append(int(rounded.scaleb(2)) if cents else rounded)
+    return out
+
+
+class UsdAccumulator:
+    """
+    sum amounts exactly and round only the total
+
+    str and Decimal are dollars, integers are cents
+
+    acc = UsdAccumulator()
+    acc.extend(ledger_amounts)
+    acc.total  # => Decimal, rounded to cents
+    """
+
+    def __init__(self):
+        self._sum = Decimal(0)
+        self.count = 0
+
+    def add(self, amount: Amount):
+        self._sum = _sum_context.add(self._sum, _to_decimal(amount))
+        self.count += 1
+
+    def extend(self, amounts: Iterable[Amount]):
+        total = self._sum
+        count = 0
+        with localcontext(_sum_context):
+            for amount in amounts:
+                if not isinstance(amount, Decimal):
+                    amount = _to_decimal(amount)
+                total += amount
+                count += 1
+        self._sum = total
+        self.count += count
+
+    @property
+    def total(self) -> Decimal:
+        return usd_round(self._sum)
+
+    @property
+    def cents(self) -> int:
+        return int(self.total.scaleb(2))
+
+
+def _walk_files(root: str, exclude: List[str]) -> Iterator[str]:
+    """
+    yield file paths, skipping directories that contain excluded substrings
+    """
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                path = entry.path
+                if any(i in path for i in exclude):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(path)
+                elif entry.is_file():
+                    yield path
+
+
+def _common_root(files: Iterable[str], sep: str) -> Path:
+    it = iter(files)
+    first = next(it, None)
+    if first is None:
+        return Path('')
+    prefix = first.split(sep)
+    single = True
+    for f in it:
+        single = False
+        parts = f.split(sep)
+        if parts[: len(prefix)] == prefix:
+            continue
+        common = 0
+        for a, b in zip(prefix, parts):
+            if a != b:
+                break
+            common += 1
+        del prefix[common:]
+        if not prefix or prefix == ['']:
+            # collapsed to root, the rest of files can't change it
+            return Path('')
+    if single:
+        return Path(first).parent
+    return Path(sep.join(prefix))
 
 
 def root_directory(target: Union[Path, BinaryIO], exclude: Optional[List[str]] = None) -> Path:
     """Returns the folder that contains the files."""
     exclude = exclude or []
     if isinstance(target, Path):
-        files = [f for f in target.glob('**/*') if f.is_file()]
+        return _common_root(_walk_files(str(target), exclude), os.sep)
     elif hasattr(target, 'read'):
+        # only the central directory is read
         with zipfile.ZipFile(target, 'r') as zip_ref:
-            files = [
-                Path(zip_item.filename) for zip_item in zip_ref.infolist() if not zip_item.is_dir()
-            ]
+            files = (
+                i.filename
+                for i in zip_ref.filelist
+                if not i.is_dir() and not any(e in i.filename for e in exclude)
+            )
+            return _common_root(files, '/')
     else:
         raise Exception('Unsupported target object')
-    paths = [f for f in files if not any(filter(lambda i: i in str(f), exclude))]
-    if len(paths) > 1:
-        prefix = os.path.commonpath(paths)
-        prefix = '' if prefix == '/' else prefix
-        root = Path(prefix)
-    elif paths:
-        root = paths[0].parent
-    else:
-        root = Path('')
-    return root
 
 
-def dict_contains(superset: Dict[Any, Any], subset: Dict[Any, Any]) -> bool:
+LIST_MODES = ('exact', 'subset', 'ordered', 'any')
+_collections = (list, tuple, set, frozenset)
+
+
+def _unlink_path(path: Any) -> Tuple[Any, ...]:
+    out: List[Any] = []
+    while path is not None:
+        path, key = path
+        out.append(key)
+    return tuple(reversed(out))
+
+
+def _item_matches(sup: Any, sub: Any, containers: Tuple[type, ...]) -> Generator[Any, Any, bool]:
+    if isinstance(sub, containers):
+        # compared by `dict_mismatch` loop, no recursion for deep nesting
+        return (yield (sup, sub))
+    return sup == sub
+
+
+def _set_mismatch(sup: Any, sub: Any, lists: str) -> bool:
+    if isinstance(sup, (set, frozenset)):
+        if lists == 'any':
+            return bool(sub) and sub.isdisjoint(sup)
+        return not sub.issubset(sup)
+    # superset items may be unhashable
+    if lists == 'any':
+        return bool(sub) and not any(item == s for item in sub for s in sup)
+    return not all(any(item == s for s in sup) for item in sub)
+
+
+def _mismatch(
+    superset: Any, subset: Any, lists: str, containers: Tuple[type, ...]
+) -> Generator[Tuple[Any, Any], bool, Optional[Tuple[Any]]]:
+    """
+    yields (superset item, subset item) pairs to compare, receives True if they match;
+    returns None on match or 1-tuple with linked path to the mismatch
+    """
+    # path is kept as linked (parent, key) pairs, so deep nesting doesn't copy it per level
+    stack: List[Tuple[Any, Any, Any]] = [(None, superset, subset)]
+    while stack:
+        path, sup, sub = stack.pop()
+        if isinstance(sub, dict):
+            if not isinstance(sup, dict):
+                return (path,)
+            for k, v in sub.items():
+                if k not in sup:
+                    return ((path, k),)
+                if isinstance(v, containers):
+                    stack.append(((path, k), sup[k], v))
+                elif v != sup[k]:
+                    return ((path, k),)
+        elif isinstance(sub, (set, frozenset)) and lists != 'exact':
+            if not isinstance(sup, _collections) or _set_mismatch(sup, sub, lists):
+                return (path,)
+        elif isinstance(sub, _collections) and lists != 'exact':
+            if not isinstance(sup, _collections):
+                return (path,)
+            if lists == 'any':
+                if not sub:
+                    continue
+                for item in sub:
+                    for sup_item in sup:
+                        if (yield from _item_matches(sup_item, item, containers)):
+                            break
+                    else:
+                        continue
+                    break
+                else:
+                    return (path,)
+                continue
+            # ordered: superset items are consumed by matched items
+            sup_items = iter(sup) if lists == 'ordered' else None
+            for pos, item in enumerate(sub):
+                for sup_item in sup if sup_items is None else sup_items:
+                    if (yield from _item_matches(sup_item, item, containers)):
+                        break
+                else:
+                    return ((path, pos),)
+        elif sub != sup:
+            return (path,)
+    return None
+
+
+def dict_mismatch(superset: Any, subset: Any, lists: str = 'exact') -> Optional[Tuple[Any, ...]]:
+    """
+    partial comparison of nested structures, returns path to the first mismatch or None
+
+    lists - how lists, tuples and sets from `subset` are matched:
+        'exact' - equal to superset value
+        'subset' - every item matches some superset item
+        'ordered' - items match superset items in the same order
+        'any' - at least one item matches some superset item
+    items are matched partially, like dictionaries
+
+    $ dict_mismatch({'a': {'b': [1, 2]}}, {'a': {'b': [2]}}) # => ('a', 'b')
+    $ dict_mismatch({'a': {'b': [1, 2]}}, {'a': {'b': [2]}}, lists='subset') # => None
+    $ dict_mismatch({'a': [{'b': 1}]}, {'a': [{'b': 2}]}, lists='ordered') # => ('a', 0)
+    """
+    if lists not in LIST_MODES:
+        raise ValueError(f'lists must be one of {LIST_MODES}')
+    containers = (dict,) if lists == 'exact' else (dict, *_collections)
+
+    # every list item comparison is a generator on this stack instead of a recursive call
+    comparisons = [_mismatch(superset, subset, lists, containers)]
+    matched: Optional[bool] = None
+    while True:
+        try:
+            sup, sub = comparisons[-1].send(matched)
+        except StopIteration as stop:
+            comparisons.pop()
+            if not comparisons:
+                return None if stop.value is None else _unlink_path(stop.value[0])
+            matched = stop.value is None
+            continue
+        comparisons.append(_mismatch(sup, sub, lists, containers))
+        matched = None
+
+
+def dict_contains(superset: Dict[Any, Any], subset: Dict[Any, Any], lists: str = 'exact') -> bool:
     """
     partial comparison dictionaries
 
     $ dict_contains({'a': 1, 'b': 2}, {'a': 1}) # => True
-    $ dict_contains({'a': 1, 'b': 2}, {'b': 1}) # => True
+    $ dict_contains({'a': 1, 'b': 2}, {'b': 1}) # => False
     $ dict_contains({'a': 1, 'b': 2}, {'c': 3}) # => False
-    $ dict_contains({'a': 1, 'b': 2}, {'b': 2}) # => False
+    $ dict_contains({'a': 1, 'b': 2}, {'b': 2}) # => True
+
+    see `dict_mismatch` for `lists` and the path to the mismatch
     """
+    return dict_mismatch(superset, subset, lists) is None
 
-    for k, v in subset.items():
-        if k not in superset:
-            return False
-        if isinstance(v, dict):
-            if not dict_contains(superset[k], subset[k]):
-                return False
-        else:
-            if v != superset[k]:
-                return False
-    return True
 
+_fill = object()
 
-def slide(iterable: Iterable[Any], size=2) -> Iterable[Any]:
-    return itertools.zip_longest(*[itertools.islice(iterable, i, sys.maxsize) for i in range(size)])
+
+def slide(iterable: Iterable[Any], size=2) -> Iterator[Tuple[Any, ...]]:
+    """
+    sliding window over any iterable, last windows are padded with None
+
+    $ list(slide(range(3))) # => [(0, 1), (1, 2), (2, None)]
+    """
+    it = itertools.chain(iterable, itertools.repeat(_fill, size - 1))
+    window = deque(itertools.islice(it, size - 1), maxlen=size)
+    for item in it:
+        window.append(item)
+        if item is not _fill:
+            yield tuple(window)
+        elif window[0] is _fill:
+            return
+        else:
+            yield tuple(None if x is _fill else x for x in window)
 
 
 def dot_get(path: str, dct: Dict[str, Any], default: Any = None, sep: str = '.'):
@@ -111,6 +492,8 @@ def dot_get(path: str, dct: Dict[str, Any], default: Any = None, sep: str = '.')
     get nested data from dictionary
 
     $ dot_get('a.b.c', {'a': {'b': {'c': [1]}}}) # => [1]
+
+    use `compile_path` to reuse parsed path
     """
     for key in path.split(sep):
         if not isinstance(dct, dict) or key not in dct:
@@ -119,55 +502,339 @@ def dot_get(path: str, dct: Dict[str, Any], default: Any = None, sep: str = '.')
     return dct
 
 
+_missing = object()
+
+
+Segments = Tuple[Tuple[str, Optional[int], bool], ...]
+
+
+def _get_segments(dct: Any, segments: Segments, default: Any) -> Any:
+    for pos, (key, idx, wildcard) in enumerate(segments):
+        if wildcard:
+            if isinstance(dct, dict):
+                items = dct.values()
+            elif isinstance(dct, list):
+                items = dct
+            else:
+                return default
+            rest = segments[pos + 1 :]
+            found = (_get_segments(item, rest, _missing) for item in items)
+            return [item for item in found if item is not _missing]
+        if isinstance(dct, dict):
+            if key not in dct:
+                return default
+            dct = dct[key]
+        elif idx is not None and isinstance(dct, list):
+            try:
+                dct = dct[idx]
+            except IndexError:
+                return default
+        else:
+            return default
+    return dct
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_path(path: str, sep: str = '.') -> Callable[..., Any]:
+    """
+    compile path once to get nested data from many dictionaries
+
+    Path segments are dictionary keys, list indices and `*` wildcard
+    that matches all dictionary values or list items and returns list of found values
+
+    $ get = compile_path('a.*.b')
+    $ get({'a': [{'b': 1}, {'c': 2}, {'b': 3}]}) # => [1, 3]
+    $ compile_path('a.0')({'a': [1, 2]}, default=None) # => 1
+    """
+    segments: Segments = tuple(
+        (key, int(key) if key.lstrip('-').isdigit() else None, key == '*')
+        for key in path.split(sep)
+    )
+    if any(idx is not None or wildcard for _, idx, wildcard in segments):
+
+        def get_segments(dct: Any, default: Any = None) -> Any:
+            return _get_segments(dct, segments, default)
+
+        return get_segments
+
+    keys = tuple(key for key, _, _ in segments)
+
+    def get(dct: Any, default: Any = None) -> Any:
+        for key in keys:
+            if not isinstance(dct, dict):
+                return default
+            dct = dct.get(key, _missing)
+            if dct is _missing:
+                return default
+        return dct
+
+    return get
+
+
+def dot_get_many(
+    paths: Iterable[str], records: Iterable[Any], default: Any = None, sep: str = '.'
+) -> Iterator[List[Any]]:
+    """
+    get values of every path for every record
+
+    $ list(dot_get_many(['a', 'b.c'], [{'a': 1, 'b': {'c': 2}}, {'a': 3}])) # => [[1, 2], [3, None]]
+    """
+    getters = [compile_path(path, sep) for path in paths]
+    for record in records:
+        yield [getter(record, default) for getter in getters]
+
+
+@functools.lru_cache(maxsize=256)
+def _expand_plan(keys: Tuple[str, ...], sep: str = '.') -> Tuple[Tuple[int, str, int], ...]:
+    """
+    steps to build nested dict for flat dict with `keys`:
+    (node, key, -1) - create nested node, (node, key, N) - set value of N-th key
+    nested nodes are created once per common prefix
+    """
+    nodes = {(): 0}
+    plan: List[Tuple[int, str, int]] = []
+    for pos, k in enumerate(keys):
+        parts = k.split(sep)
+        node = 0
+        for depth in range(1, len(parts)):
+            prefix = tuple(parts[:depth])
+            child = nodes.get(prefix)
+            if child is None:
+                child = nodes[prefix] = len(nodes)
+                plan.append((node, parts[depth - 1], -1))
+            node = child
+        plan.append((node, parts[-1], pos))
+    return tuple(plan)
+
+
+def _expand(pattern: Dict[str, Any], plan: Tuple[Tuple[int, str, int], ...]) -> Dict[str, Any]:
+    values = list(pattern.values())
+    out: Dict[str, Any] = {}
+    nodes = [out]
+    for node, key, pos in plan:
+        if pos < 0:
+            nodes.append(nodes[node].setdefault(key, {}))
+        else:
+            nodes[node][key] = values[pos]
+    return out
+
+
 def expand_dot(pattern: Dict[str, Any]) -> Dict[str, Any]:
     """
     {'a.b.c': 1} => {'a':{'b':{'c': 1}}}
     """
-    out = {}
-    for k, v in pattern.items():
-        if '.' in k:
-            curr = out
-            for sub_k, has_next in slide(k.split('.')):
-                if has_next:
-                    curr = curr.setdefault(sub_k, {})
-                else:
-                    curr[sub_k] = v
-        else:
-            out[k] = v
+    return _expand(pattern, _expand_plan(tuple(pattern)))
+
+
+def expand_dot_many(records: Iterable[Dict[str, Any]], sep: str = '.') -> List[Dict[str, Any]]:
+    """
+    expand_dot for many records, records with the same keys share parsed key structure
+    """
+    out = []
+    for record in records:
+        out.append(_expand(record, _expand_plan(tuple(record), sep)))
     return out
 
 
 _initial_missing = object()
 
 
-async def areduce(function, sequence, initial=_initial_missing):
+async def areduce(function, sequence, initial=_initial_missing, tree=False, limit=None):
     """
     asynchronous implementation of the reduce function
     based on: `functools.reduce`
 
+    sequence can be sync or async iterable
+
+    tree=True - for associative functions: merge neighbour pairs concurrently
+    (at most `limit` at once) level by level, instead of one after another
+
     Example:
     async def asum_two(a, b):
         return a + b
 
     await areduce(asum_two, [1, 2, 3, 4, 5])
     """
-    it = iter(sequence)
+    if tree:
+        values = [x async for x in _aiter(sequence)]
+        if initial is not _initial_missing:
+            values.insert(0, initial)
+        if not values:
+            raise TypeError('areduce() of empty sequence with no initial value')
+        while len(values) > 1:
+            merged = await agather_limited(
+                [function(values[i], values[i + 1]) for i in range(0, len(values) - 1, 2)],
+                limit,
+            )
+            if len(values) % 2:
+                merged.append(values[-1])
+            values = merged
+        return values[0]
+
+    it = _aiter(sequence)
 
     if initial is _initial_missing:
         try:
-            value = next(it)
-        except StopIteration:
+            value = await it.__anext__()
+        except StopAsyncIteration:
             raise TypeError('areduce() of empty sequence with no initial value') from None
     else:
         value = initial
 
-    for element in it:
+    async for element in it:
         value = await function(value, element)
 
     return value
 
 
-def chunks(lst: Sequence, n: int):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i : i + n]
+async def agather_limited(aws: Iterable[Awaitable[Any]], limit: Optional[int] = None) -> List[Any]:
+    """
+    like `asyncio.gather`, but runs at most `limit` awaitables at once
+    results are in the order of `aws`, the first exception cancels the rest and is raised
+
+    await agather_limited((fetch(url) for url in urls), 10)
+    """
+    if limit is None:
+        aws = list(aws)
+        limit = len(aws)
+    pending = enumerate(aws)
+    results: Dict[int, Any] = {}
+
+    async def worker():
+        for pos, aw in pending:
+            results[pos] = await aw
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(limit)]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        for task in workers:
+            task.cancel()
+        for _, aw in pending:
+            if asyncio.iscoroutine(aw):
+                aw.close()
+        raise
+    return [results[pos] for pos in range(len(results))]
+
+
+async def amap(
+    function: Callable[[Any], Awaitable[Any]],
+    iterable: Union[Iterable[Any], AsyncIterable[Any]],
+    limit: int = 10,
+) -> AsyncIterator[Any]:
+    """
+    apply async function to items of sync or async iterable, at most `limit` at once
+    results are yielded in the order of items
+
+    async for user in amap(fetch_user, user_ids, limit=20):
+        ...
+    """
+    running: Deque['asyncio.Future[Any]'] = deque()
+    try:
+        async for item in _aiter(iterable):
+            if len(running) >= limit:
+                yield await running.popleft()
+            running.append(asyncio.ensure_future(function(item)))
+        while running:
+            yield await running.popleft()
+    finally:
+        for task in running:
+            task.cancel()
+
+
+async def afilter(
+    predicate: Callable[[Any], Awaitable[bool]],
+    iterable: Union[Iterable[Any], AsyncIterable[Any]],
+    limit: int = 10,
+) -> AsyncIterator[Any]:
+    """
+    yield items of sync or async iterable for which async predicate is true
+    predicates are awaited concurrently, at most `limit` at once
+    """
+
+    async def check(item: Any) -> Tuple[Any, bool]:
+        return item, await predicate(item)
+
+    async for item, ok in amap(check, iterable, limit):
+        if ok:
+            yield item
+
+
+def chunks(lst: Iterable[Any], n: int):
+    """
+    Yield successive n-sized chunks from lst.
+
+    Objects with `__len__` and `__getitem__` (lists, tuples, strings, numpy arrays)
+    are sliced, chunks keep their type. Django querysets are sized with `.count()`
+    and every chunk is a queryset with LIMIT/OFFSET, rows are not loaded in advance;
+    order the queryset to get stable chunks. Other iterables (generators, files,
+    `queryset.iterator()`) and mappings are consumed lazily into lists.
+    """
+    # django is optional, a queryset can exist only when it's imported
+    queryset_class = getattr(sys.modules.get('django.db.models'), 'QuerySet', None)
+    if queryset_class is not None and isinstance(lst, queryset_class):
+        size = lst.count()
+    elif hasattr(lst, '__getitem__') and hasattr(lst, '__len__') and not isinstance(lst, Mapping):
+        size = len(cast(Sequence[Any], lst))
+    else:
+        it = iter(lst)
+        while chunk := list(itertools.islice(it, n)):
+            yield chunk
+        return
+    seq = cast(Sequence[Any], lst)
+    for i in range(0, size, n):
+        yield seq[i : i + n]
+
+
+async def _aiter(iterable: Union[Iterable[Any], AsyncIterable[Any]]) -> AsyncIterator[Any]:
+    if isinstance(iterable, AsyncIterable):
+        async for item in iterable:
+            yield item
+    else:
+        for item in iterable:
+            yield item
+
+
+async def achunks(
+    iterable: Union[Iterable[Any], AsyncIterable[Any]], n: int
+) -> AsyncIterator[List[Any]]:
+    """
+    Yield successive n-sized lists from async (or sync) iterable.
+
+    async for rows in achunks(cursor, 1000):
+        await bulk_insert(rows)
+    """
+    chunk: List[Any] = []
+    async for item in _aiter(iterable):
+        chunk.append(item)
+        if len(chunk) == n:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def aslide(
+    iterable: Union[Iterable[Any], AsyncIterable[Any]], size=2
+) -> AsyncIterator[Tuple[Any, ...]]:
+    """
+    `slide` for async (or sync) iterable
+    """
+    window: Deque[Any] = deque(maxlen=size)
+    async for item in _aiter(iterable):
+        window.append(item)
+        if len(window) == size:
+            yield tuple(window)
+    if not window:
+        return
+    # windows starting at the last items
+    if len(window) < size:
+        pending = len(window)
+        window.extend([_fill] * (size - len(window)))
+    else:
+        pending = size - 1
+        window.append(_fill)
+    while pending:
+        yield tuple(None if x is _fill else x for x in window)
+        window.append(_fill)
+        pending -= 1
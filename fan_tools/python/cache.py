@@ -0,0 +1,362 @@
+# pyright: strict
+import fcntl
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, suppress
+from pathlib import Path
+from typing import (
+    Any,
+    Dict,
+    Generic,
+    Hashable,
+    Iterator,
+    NamedTuple,
+    Optional,
+    Protocol,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+D = TypeVar('D')
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    currsize: int
+    currbytes: int
+
+
+class LRUCache(Generic[K, V]):
+    """
+    thread-safe in-memory LRU with optional size and age bounds
+
+    :param max_entries: maximum number of entries, None for unbounded
+    :param max_bytes: maximum sum of entry sizes passed to `set`, None for unbounded
+    :param ttl: seconds an entry is served after it was set, None for no expiration
+    """
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = 128,
+        max_bytes: Optional[int] = None,
+        ttl: Optional[float] = None,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # key => (value, size, expires_at)
+        self._data: 'OrderedDict[K, Tuple[V, int, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry[2] > time.monotonic()
+
+    def get(self, key: K, default: D = None) -> Union[V, D]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, size, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self._bytes -= size
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: K, value: V, size: int = 0):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else float('inf')
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            if self.max_bytes is not None and size > self.max_bytes:
+                # never fits, keeping it would flush everything else
+                return
+            self._data[key] = (value, size, expires_at)
+            self._bytes += size
+            self._evict()
+
+    def pop(self, key: K, default: D = None) -> Union[V, D]:
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+            self._bytes -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.evictions, len(self._data), self._bytes)
+
+    def _evict(self):
+        data = self._data
+        while data and (
+            (self.max_entries is not None and len(data) > self.max_entries)
+            or (self.max_bytes is not None and self._bytes > self.max_bytes)
+        ):
+            _, (_, size, _) = data.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+
+
+class CacheStore(Protocol):
+    """
+    persistent key => JSON serializable value storage used by `memoize`
+
+    Stores with `indexed = True` attribute aren't loaded in advance by `memoize`.
+    """
+
+    def get(self, key: str, default: D = None) -> Union[Any, D]:
+        ...
+
+    def set(self, key: str, value: Any) -> None:
+        ...
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        ...
+
+    def clear(self) -> None:
+        ...
+
+    def compact(self) -> None:
+        ...
+
+
+@contextmanager
+def file_lock(pth: Path):
+    """
+    exclusive inter-process lock on a sidecar `.lock` file
+    """
+    lock_pth = pth.with_name(pth.name + '.lock')
+    with open(lock_pth, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def atomic_write(pth: Path, data: Union[str, bytes]):
+    """
+    write to a temporary file in the same directory and rename it over `pth`
+    """
+    fd, tmp = tempfile.mkstemp(dir=pth.parent, prefix=f'.{pth.name}.')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+        os.replace(tmp, pth)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+
+
+class JsonFileStore:
+    """
+    single JSON object with all entries, rewritten on every `set`
+
+    The parsed content is reused while the file's mtime and size don't change.
+    Writers are serialized with a file lock and replace the file atomically,
+    so concurrent processes don't lose each other's entries.
+    """
+
+    def __init__(self, pth: Path):
+        self.pth = pth
+        self._data: Dict[str, Any] = {}
+        self._stamp: Optional[Tuple[int, int]] = None
+
+    def _load(self) -> Dict[str, Any]:
+        try:
+            st = self.pth.stat()
+        except FileNotFoundError:
+            self._data, self._stamp = {}, None
+            return self._data
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp != self._stamp:
+            self._data = json.loads(self.pth.read_text())
+            self._stamp = stamp
+        return self._data
+
+    def get(self, key: str, default: D = None) -> Union[Any, D]:
+        return self._load().get(key, default)
+
+    def set(self, key: str, value: Any):
+        with file_lock(self.pth):
+            data = dict(self._load())
+            data[key] = value
+            atomic_write(self.pth, json.dumps(data))
+            st = self.pth.stat()
+            self._data, self._stamp = data, (st.st_mtime_ns, st.st_size)
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        return iter(list(self._load().items()))
+
+    def clear(self):
+        with file_lock(self.pth):
+            with suppress(FileNotFoundError):
+                self.pth.unlink()
+        self._data, self._stamp = {}, None
+
+    def compact(self):
+        pass
+
+
+class JsonLogStore:
+    """
+    append-only log with one `[key, value]` JSON line per `set`
+
+    A miss costs a single locked append. Readers keep an index and only parse
+    lines appended since the previous read. `compact` rewrites the log keeping
+    the latest value for every key.
+    """
+
+    def __init__(self, pth: Path):
+        self.pth = pth
+        self._index: Dict[str, Any] = {}
+        self._inode: Optional[int] = None
+        self._offset = 0
+        # memoize of coroutines calls the store from executor threads
+        self._lock = threading.Lock()
+
+    def _refresh(self) -> Dict[str, Any]:
+        with self._lock:
+            return self._load()
+
+    def _load(self) -> Dict[str, Any]:
+        try:
+            f = open(self.pth, 'rb')
+        except FileNotFoundError:
+            self._index, self._inode, self._offset = {}, None, 0
+            return self._index
+        with f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != self._inode or st.st_size < self._offset:
+                # replaced by compaction or cleared
+                self._index, self._inode, self._offset = {}, st.st_ino, 0
+            if st.st_size == self._offset:
+                return self._index
+            f.seek(self._offset)
+            chunk = f.read()
+        # a concurrent writer may be in the middle of a line
+        end = chunk.rfind(b'\n') + 1
+        for line in chunk[:end].splitlines():
+            if line:
+                key, value = json.loads(line)
+                self._index[key] = value
+        self._offset += end
+        return self._index
+
+    def get(self, key: str, default: D = None) -> Union[Any, D]:
+        index = self._index
+        if key in index:
+            return index[key]
+        return self._refresh().get(key, default)
+
+    def set(self, key: str, value: Any):
+        line = json.dumps([key, value]) + '\n'
+        with file_lock(self.pth):
+            with open(self.pth, 'a') as f:
+                f.write(line)
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        with self._lock:
+            return iter(list(self._load().items()))
+
+    def clear(self):
+        with file_lock(self.pth):
+            with suppress(FileNotFoundError):
+                self.pth.unlink()
+            with self._lock:
+                self._index, self._inode, self._offset = {}, None, 0
+
+    def compact(self):
+        with file_lock(self.pth), self._lock:
+            self._inode = None
+            index = self._load()
+            if self._inode is None:
+                return
+            atomic_write(self.pth, ''.join(json.dumps([k, v]) + '\n' for k, v in index.items()))
+            self._inode = None
+
+
+class SqliteStore:
+    """
+    sqlite table in WAL mode, safe for concurrent processes
+    """
+
+    indexed = True
+
+    def __init__(self, pth: Path, timeout: float = 30):
+        self.pth = pth
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            pth, timeout=timeout, isolation_level=None, check_same_thread=False
+        )
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self._conn.execute('PRAGMA journal_mode=WAL')
+                break
+            except sqlite3.OperationalError:
+                # switching to WAL fails at once when other processes open the file
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS memoize (key TEXT PRIMARY KEY, value TEXT NOT NULL)'
+        )
+
+    def get(self, key: str, default: D = None) -> Union[Any, D]:
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM memoize WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO memoize (key, value) VALUES (?, ?)',
+                (key, json.dumps(value)),
+            )
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute('SELECT key, value FROM memoize').fetchall()
+        return ((k, json.loads(v)) for k, v in rows)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM memoize')
+
+    def compact(self):
+        with self._lock:
+            self._conn.execute('VACUUM')
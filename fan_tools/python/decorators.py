@@ -3,11 +3,35 @@ import asyncio
 import functools
 import json
 import logging
+import random
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
 from hashlib import md5
 from inspect import isfunction
 from pathlib import Path
 from types import FunctionType
-from typing import Awaitable, Callable, cast, Dict, Generic, Protocol, Type, TypeVar, Union
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    cast,
+    ContextManager,
+    Deque,
+    Dict,
+    Generic,
+    Optional,
+    Protocol,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
+
+from fan_tools.metrics import send_metric
+
+from .cache import atomic_write, CacheStore, JsonFileStore, LRUCache
 
 
 try:
@@ -17,62 +41,327 @@ except ImportError:
 
 
 default_logger = logging.getLogger('fantools.python')
+_missing = object()
 R = TypeVar('R')
 P = ParamSpec('P')
 
 
+class TokenBucket:
+    """
+    thread-safe token bucket: refills `rate` tokens per second up to `capacity`
+
+    Share one instance between `retry` decorators to get a process-wide retry budget.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, tokens: float = 1) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+
 def retry(
     exceptions: Type[Exception] = Exception,
     tries: int = -1,
     logger: logging.Logger = default_logger,
+    backoff: float = 0,
+    max_backoff: float = 60,
+    jitter: bool = True,
+    deadline: Optional[float] = None,
+    retry_after: Optional[Callable[[Exception], Optional[float]]] = None,
+    budget: Optional[TokenBucket] = None,
 ):
     """
     Executes a function and retries it if it failed.
 
     :param exceptions: an exception or a tuple of exceptions to catch. default: Exception.
-    :param tries: the maximum number of attempts. default: -1 (infinite).
+    :param tries: the maximum number of attempts per call. default: -1 (infinite).
     :param logger: will record a call retry warning.
+    :param backoff: delay before the first retry, doubled for every next one. default: 0.
+    :param max_backoff: upper limit for the delay.
+    :param jitter: sleep a random time between 0 and the delay (full jitter).
+    :param deadline: seconds since the first attempt after which no more retries are done.
+    :param retry_after: callable that receives the exception and returns a delay to use
+        instead of backoff (eg. from `Retry-After` header), or None to use backoff.
+    :param budget: every retry takes a token from it, when it is empty the exception is raised.
     """
 
+    def get_delay(attempt: int, started: float, e: Exception) -> Optional[float]:
+        """
+        returns None when the call shouldn't be retried
+        """
+        if attempt == tries:
+            return None
+        delay = retry_after(e) if retry_after else None
+        if delay is None:
+            delay = min(max_backoff, backoff * 2 ** (attempt - 1))
+            if jitter:
+                delay = random.uniform(0, delay)
+        if deadline is not None and time.monotonic() - started + delay > deadline:
+            return None
+        if budget and not budget.consume():
+            logger.warning('Retry budget is exhausted')
+            return None
+        logger.exception('%s, retrying...', e)
+        return delay
+
     def decorator(func: Callable[P, R]) -> Union[Callable[P, R], Callable[P, Awaitable[R]]]:
         if asyncio.iscoroutinefunction(func):
 
             @functools.wraps(func)
             async def async_wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
-                nonlocal tries
+                if not tries:
+                    raise ValueError('tries must be greater than 0')
                 f = functools.partial(func, *args, **kwargs)
-                while tries:
+                started = time.monotonic()
+                attempt = 0
+                while True:
                     try:
                         return await f()
                     except exceptions as e:
-                        tries -= 1
-                        if not tries:
+                        attempt += 1
+                        delay = get_delay(attempt, started, e)
+                        if delay is None:
                             raise
-                        logger.exception('%s, retrying...', e)
-                raise ValueError('tries must be greater than 0')
+                    if delay:
+                        await asyncio.sleep(delay)
 
             return async_wrapper
         else:
 
             @functools.wraps(func)
             def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
-                nonlocal tries
+                if not tries:
+                    raise ValueError('tries must be greater than 0')
                 f = functools.partial(func, *args, **kwargs)
-                while tries:
+                started = time.monotonic()
+                attempt = 0
+                while True:
                     try:
                         return f()
                     except exceptions as e:
-                        tries -= 1
-                        if not tries:
+                        attempt += 1
+                        delay = get_delay(attempt, started, e)
+                        if delay is None:
                             raise
-                        logger.exception('%s, retrying...', e)
-                raise ValueError('tries must be greater than 0')
+                    if delay:
+                        time.sleep(delay)
 
         return wrapper
 
     return decorator
 
 
+class CircuitOpenError(Exception):
+    """
+    raised instead of calling the function while the circuit is open
+
+    `retry_after` is the number of seconds until the next trial call, so the breaker
+    composes with `retry(retry_after=lambda e: getattr(e, 'retry_after', None))`
+    """
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f'Circuit {name!r} is open')
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Fails fast with `CircuitOpenError` while a dependency is failing.
+
+    closed: calls pass, the circuit opens when at least `min_calls` of the last `window`
+        calls were made and `failure_rate` of them failed.
+    open: calls are rejected for `cooldown` seconds.
+    half_open: up to `half_open_calls` trial calls pass, if all of them succeed
+        the circuit closes, any failure opens it again.
+
+    Only `exceptions` are counted as failures. The same instance can decorate several
+    sync or async functions, pass `thread_safe=True` to share it between threads.
+    State transitions are sent as `circuit_breaker` metric, see `stats()` for counters.
+
+    Usage:
+
+        pg_breaker = CircuitBreaker('postgres', exceptions=OperationalError)
+
+        @retry(tries=3, backoff=1, retry_after=lambda e: getattr(e, 'retry_after', None))
+        @pg_breaker
+        def query():
+            ...
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(
+        self,
+        name: str = 'default',
+        exceptions: Union[Type[Exception], Tuple[Type[Exception], ...]] = Exception,
+        failure_rate: float = 0.5,
+        window: int = 20,
+        min_calls: int = 10,
+        cooldown: float = 30,
+        half_open_calls: int = 1,
+        thread_safe: bool = False,
+        logger: logging.Logger = default_logger,
+    ):
+        self.name = name
+        self.exceptions = exceptions
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.half_open_calls = half_open_calls
+        self.logger = logger
+        self._lock: ContextManager[Any] = threading.Lock() if thread_safe else nullcontext()
+        self._window: Deque[bool] = deque(maxlen=window)
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._trials = 0
+        self._trial_successes = 0
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and self._remaining() <= 0:
+                return self.HALF_OPEN
+            return self._state
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            window = len(self._window)
+            return {
+                'name': self.name,
+                'state': self._state,
+                'calls': self.calls,
+                'failures': self.failures,
+                'rejected': self.rejected,
+                'failure_rate': sum(self._window) / window if window else 0.0,
+            }
+
+    def reset(self):
+        with self._lock:
+            self._window.clear()
+            self._set_state(self.CLOSED)
+
+    def _remaining(self) -> float:
+        return self._opened_at + self.cooldown - time.monotonic()
+
+    def _set_state(self, state: str):
+        if state == self._state:
+            return
+        self.logger.warning('Circuit %r: %s => %s', self.name, self._state, state)
+        self._state = state
+        self._trials = self._trial_successes = 0
+        if state == self.OPEN:
+            self._opened_at = time.monotonic()
+        elif state == self.CLOSED:
+            self._window.clear()
+        send_metric('circuit_breaker', tags={'name': self.name, 'state': state})
+
+    def _before_call(self) -> bool:
+        """
+        returns True for a trial call in half_open state
+        """
+        with self._lock:
+            if self._state == self.OPEN:
+                remaining = self._remaining()
+                if remaining > 0:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, remaining)
+                self._set_state(self.HALF_OPEN)
+            if self._state == self.HALF_OPEN:
+                if self._trials >= self.half_open_calls:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, self.cooldown)
+                self._trials += 1
+                return True
+            return False
+
+    def _after_call(self, trial: bool, failed: Optional[bool]):
+        """
+        failed is None when the call was interrupted (eg. cancelled) and doesn't count
+        """
+        with self._lock:
+            if failed is None:
+                if trial and self._state == self.HALF_OPEN:
+                    self._trials -= 1
+                return
+            self.calls += 1
+            self.failures += int(failed)
+            if self._state == self.HALF_OPEN and trial:
+                if failed:
+                    self._set_state(self.OPEN)
+                    return
+                self._trial_successes += 1
+                if self._trial_successes >= self.half_open_calls:
+                    self._set_state(self.CLOSED)
+            elif self._state == self.CLOSED:
+                window = self._window
+                window.append(failed)
+                if (
+                    failed
+                    and len(window) >= self.min_calls
+                    and sum(window) / len(window) >= self.failure_rate
+                ):
+                    self._set_state(self.OPEN)
+
+    def __call__(self, func: Callable[P, R]) -> Callable[P, R]:
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args: P.args, **kwargs: P.kwargs) -> Any:
+                trial = self._before_call()
+                failed = None
+                try:
+                    result = await func(*args, **kwargs)
+                    failed = False
+                    return result
+                except self.exceptions:
+                    failed = True
+                    raise
+                except Exception:
+                    failed = False
+                    raise
+                finally:
+                    self._after_call(trial, failed)
+
+            return cast(Callable[P, R], async_wrapper)
+
+        @functools.wraps(func)
+        def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+            trial = self._before_call()
+            failed = None
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            except self.exceptions:
+                failed = True
+                raise
+            except Exception:
+                failed = False
+                raise
+            finally:
+                self._after_call(trial, failed)
+
+        return wrapper
+
+
 class PydanticBaseModel(Protocol):
     def parse_file(self, fname: Union[str, Path]) -> 'PydanticBaseModel':
         ...
@@ -87,45 +376,167 @@ ModelType = TypeVar('ModelType', bound=PydanticBaseModel)
 class cache_async(Generic[ModelType]):
     """
     file cache for async functions that returns pydantic models
-    NB: it doesn't use parameters to generate the cache file name
+
+    By default a single model is cached in `fname` regardless of the parameters.
+    With `key` models are cached per key, one `fname / f'{key}.json'` file per key.
+
+    :param key: callable that receives the call parameters and returns a cache key
+        usable as a file name, eg. `args_key`
+    :param max_entries: maximum number of models kept in memory
+    :param ttl: seconds after which a cached model is recomputed, None for no expiration
+    :param stale_while_revalidate: return an expired model immediately
+        and recompute it in background
+
+    Files are written atomically in the default executor.
     """
 
-    def __init__(self, fname: Path, model: ModelType, default: ModelType):
+    def __init__(
+        self,
+        fname: Path,
+        model: ModelType,
+        default: ModelType,
+        key: Optional[Callable[..., str]] = None,
+        max_entries: Optional[int] = 128,
+        ttl: Optional[float] = None,
+        stale_while_revalidate: bool = False,
+    ):
         self.fname = fname
+        self.model = model
         self._default = default
-        self.cache = default
-        # load from file
-        if self.fname.exists():
-            self.cache = model.parse_file(self.fname)
+        self.key = key
+        self.ttl = ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        # key => (model, time.time() when it was computed)
+        self.memory: LRUCache[str, Tuple[ModelType, float]] = LRUCache(max_entries)
+        self._inflight: Dict[str, 'asyncio.Task[ModelType]'] = {}
+        if key is None:
+            # load from file
+            self.memory.set('', self._load('') or (default, time.time()))
+
+    @property
+    def cache(self) -> ModelType:
+        entry = self.memory.get('')
+        return entry[0] if entry else self._default
+
+    def _path(self, key: str) -> Path:
+        if self.key is None:
+            return self.fname
+        return self.fname / f'{key}.json'
+
+    def _load(self, key: str) -> Optional[Tuple[ModelType, float]]:
+        pth = self._path(key)
+        try:
+            return cast(ModelType, self.model.parse_file(pth)), pth.stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def _store(self, key: str, value: ModelType):
+        pth = self._path(key)
+        pth.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(pth, value.json())
+
+    async def _compute(
+        self, key: str, func: Callable[..., Awaitable[ModelType]], *args: Any, **kwargs: Any
+    ) -> ModelType:
+        try:
+            value = await func(*args, **kwargs)
+            self.memory.set(key, (value, time.time()))
+            await asyncio.get_running_loop().run_in_executor(None, self._store, key, value)
+            return value
+        finally:
+            del self._inflight[key]
+
+    def _compute_once(
+        self, key: str, func: Callable[..., Awaitable[ModelType]], *args: Any, **kwargs: Any
+    ) -> 'asyncio.Task[ModelType]':
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._compute(key, func, *args, **kwargs))
+            self._inflight[key] = task
+        return task
+
+    def _on_revalidated(self, task: 'asyncio.Task[ModelType]'):
+        if not task.cancelled() and task.exception():
+            default_logger.error('Cannot revalidate cache: %r', task.exception())
 
     def __call__(self, func: Callable[P, Awaitable[ModelType]]):
         @functools.wraps(func)
         async def wrapper(*args: P.args, **kwargs: P.kwargs) -> ModelType:
-            if self.cache:
-                return self.cache
-            value = await func(*args, **kwargs)
-            self.cache = value
-            self.fname.write_text(self.cache.json())
-            return value
+            key = self.key(*args, **kwargs) if self.key else ''
+            entry = self.memory.get(key)
+            if entry is None and self.key:
+                loop = asyncio.get_running_loop()
+                entry = await loop.run_in_executor(None, self._load, key)
+                if entry:
+                    self.memory.set(key, entry)
+
+            if entry and entry[0]:
+                value, computed_at = entry
+                if self.ttl is None or time.time() - computed_at < self.ttl:
+                    return value
+                if self.stale_while_revalidate:
+                    if key not in self._inflight:
+                        task = self._compute_once(key, func, *args, **kwargs)
+                        task.add_done_callback(self._on_revalidated)
+                    return value
+
+            return await asyncio.shield(self._compute_once(key, func, *args, **kwargs))
 
         wrapper.reset_cache = self.reset_cache  # type: ignore
 
         return wrapper
 
     def reset_cache(self):
-        self.cache = self._default
-        if self.fname.exists():
-            self.fname.unlink()
+        self.memory.clear()
+        if self.key is None:
+            self.memory.set('', (self._default, time.time()))
+            if self.fname.exists():
+                self.fname.unlink()
+        elif self.fname.exists():
+            for pth in self.fname.glob('*.json'):
+                pth.unlink()
 
 
 In = ParamSpec('In')
 Out = TypeVar('Out')
 
 
-def memoize(fname: Union[FunctionType, str, Path, None] = None):
+def args_key(*args: object, **kwargs: object) -> str:
+    """
+    cache key for JSON serializable call arguments
+    """
+    return md5(json.dumps({'args': args, 'kwargs': kwargs}).encode('utf8')).hexdigest()
+
+
+def memoize(
+    fname: Union[FunctionType, str, Path, None] = None,
+    *,
+    max_entries: Optional[int] = 1024,
+    max_bytes: Optional[int] = None,
+    ttl: Optional[float] = None,
+    backend: Callable[[Path], CacheStore] = JsonFileStore,
+):
     """
     memoize function call to filename
     input and outputs must be JSON serializable
+
+    Results are kept JSON-encoded in an in-memory LRU tier in front of the file, so hits
+    don't touch the disk and every hit returns a fresh copy, callers can't mutate cached
+    results. The file is read once on the first call to warm the tier with the latest
+    `max_entries` results; indexed backends (`SqliteStore`) aren't read in advance,
+    their entries get to memory on the first lookup.
+
+    :param max_entries: maximum number of results kept in memory, None for unbounded
+    :param max_bytes: maximum size of JSON-encoded results kept in memory
+    :param ttl: seconds a result is served from memory before the file is consulted again
+    :param backend: storage for `fname`: `JsonFileStore` (default, single JSON object),
+        `JsonLogStore` (append-only log) or `SqliteStore`
+
+    Memory tier counters are available via `func.cache_info()`,
+    `func.compact()` compacts the storage.
+
+    Coroutine functions are supported: storage I/O runs in the default executor
+    and concurrent calls with the same arguments share a single computation.
     """
 
     call_func: Union[FunctionType, None] = None
@@ -136,34 +547,99 @@ def memoize(fname: Union[FunctionType, str, Path, None] = None):
     elif not fname:
         pth = Path('.cache/memoized.json')
     else:
-        pth = cast(Path, fname)
+        pth = Path(cast(Union[str, Path], fname))
 
     pth.parent.mkdir(parents=True, exist_ok=True)
 
+    store = backend(pth)
+    # key => JSON-encoded result
+    memory: LRUCache[str, str] = LRUCache(max_entries, max_bytes, ttl)
+    # per-key lookups of indexed stores are cheap, loading them whole is not
+    warmed = getattr(store, 'indexed', False)
+
+    def remember(key: str, value: Any) -> str:
+        encoded = json.dumps(value)
+        memory.set(key, encoded, len(encoded))
+        return encoded
+
+    def warm():
+        nonlocal warmed
+        warmed = True
+        # older entries would be evicted right away
+        for key, value in deque(store.items(), maxlen=max_entries):
+            remember(key, value)
+
     def reset_cache():
-        if pth.exists():
-            pth.unlink()
+        memory.clear()
+        store.clear()
 
     def _wrapped(func: Callable[In, Out]) -> Callable[In, Out]:
+        if asyncio.iscoroutinefunction(func):
+            _inner = _wrapped_async(func)
+        else:
+            _inner = _wrapped_sync(func)
+        _inner.reset_cache = reset_cache  # type: ignore
+        _inner.cache_info = memory.info  # type: ignore
+        _inner.compact = store.compact  # type: ignore
+        return _inner
+
+    def _wrapped_sync(func: Callable[In, Out]) -> Callable[In, Out]:
         @functools.wraps(func)
         def _inner(*args: In.args, **kwargs: In.kwargs) -> Out:
-            k = md5(json.dumps({'args': args, 'kwargs': kwargs}).encode('utf8'))
-
-            cached: Dict[str, Out] = {}
-            if pth.exists():
-                cached = json.loads(pth.read_text())
+            key = args_key(*args, **kwargs)
 
-            key = k.hexdigest()
+            if not warmed:
+                warm()
 
-            if key in cached:
-                return cached[key]
+            encoded = memory.get(key)
+            if encoded is not None:
+                return json.loads(encoded)
 
-            res = func(*args, **kwargs)
-            cached[k.hexdigest()] = res
-            pth.write_text(json.dumps(cached))
+            res = store.get(key, _missing)
+            if res is _missing:
+                res = func(*args, **kwargs)
+                store.set(key, res)
+            remember(key, res)
             return res
 
-        _inner.reset_cache = reset_cache
+        return _inner
+
+    def _wrapped_async(func: Callable[In, Awaitable[Out]]) -> Callable[In, Awaitable[Out]]:
+        # key => task computing the value, concurrent callers await the same task
+        inflight: Dict[str, 'asyncio.Task[str]'] = {}
+
+        async def compute(key: str, *args: In.args, **kwargs: In.kwargs) -> str:
+            loop = asyncio.get_running_loop()
+            try:
+                res = await loop.run_in_executor(None, store.get, key, _missing)
+                if res is _missing:
+                    res = await func(*args, **kwargs)
+                    await loop.run_in_executor(None, store.set, key, res)
+                return remember(key, res)
+            finally:
+                del inflight[key]
+
+        @functools.wraps(func)
+        async def _inner(*args: In.args, **kwargs: In.kwargs) -> Out:
+            nonlocal warmed
+            key = args_key(*args, **kwargs)
+
+            if not warmed:
+                warmed = True
+                await asyncio.get_running_loop().run_in_executor(None, warm)
+
+            encoded = memory.get(key)
+            if encoded is not None:
+                return json.loads(encoded)
+
+            task = inflight.get(key)
+            if task is None:
+                task = asyncio.ensure_future(compute(key, *args, **kwargs))
+                inflight[key] = task
+            # cancellation of one caller must not cancel the computation for the others,
+            # each of them gets its own copy of the result
+            return json.loads(await asyncio.shield(task))
+
         return _inner
 
     if call_func:
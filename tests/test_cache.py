@@ -0,0 +1,146 @@
+import json
+import multiprocessing
+import threading
+from contextlib import suppress
+
+import pytest
+
+from fan_tools.python import memoize
+from fan_tools.python.cache import JsonFileStore, JsonLogStore, LRUCache, SqliteStore
+
+
+STORES = [JsonFileStore, JsonLogStore, SqliteStore]
+
+
+def test_01_lru_bytes():
+    cache = LRUCache(max_entries=None, max_bytes=10)
+    cache.set('a', 1, size=6)
+    cache.set('b', 2, size=6)
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    # larger than the whole cache, never stored
+    cache.set('c', 3, size=11)
+    assert cache.get('c') is None
+    assert cache.info().evictions == 1
+
+
+@pytest.mark.parametrize('store_cls', STORES)
+def test_02_store_roundtrip(tmp_path, store_cls):
+    store = store_cls(tmp_path / 'store')
+    assert store.get('a') is None
+    store.set('a', {'x': 1})
+    store.set('b', [1, 2])
+    store.set('a', {'x': 2})
+    assert store.get('a') == {'x': 2}
+    assert dict(store.items()) == {'a': {'x': 2}, 'b': [1, 2]}
+
+    # another instance sees the same data
+    assert store_cls(tmp_path / 'store').get('b') == [1, 2]
+
+    store.compact()
+    assert dict(store_cls(tmp_path / 'store').items()) == {'a': {'x': 2}, 'b': [1, 2]}
+
+    store.clear()
+    assert store.get('a') is None
+    assert list(store.items()) == []
+
+
+def test_03_log_compaction(tmp_path):
+    pth = tmp_path / 'log.jsonl'
+    store = JsonLogStore(pth)
+    reader = JsonLogStore(pth)
+    for i in range(10):
+        store.set('a', i)
+    assert reader.get('a') == 9
+    assert len(pth.read_text().splitlines()) == 10
+
+    store.compact()
+    assert pth.read_text().splitlines() == [json.dumps(['a', 9])]
+
+    store.set('b', 1)
+    assert reader.get('b') == 1
+    assert reader.get('a') == 9
+
+
+def test_03_log_threaded_readers(tmp_path, monkeypatch):
+    pth = tmp_path / 'log.jsonl'
+    writer = JsonLogStore(pth)
+    reader = JsonLogStore(pth)
+    for i in range(10):
+        writer.set(f'key-{i}', i)
+
+    # both readers stop in the middle of refresh, if the store lets them
+    barrier = threading.Barrier(2, timeout=0.2)
+    json_loads = json.loads
+
+    def loads(data):
+        if threading.current_thread().name.startswith('reader'):
+            with suppress(threading.BrokenBarrierError):
+                barrier.wait()
+        return json_loads(data)
+
+    monkeypatch.setattr(json, 'loads', loads)
+    errors = []
+
+    def read():
+        try:
+            reader.get('missing')
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read, name=f'reader-{i}') for i in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    monkeypatch.undo()
+
+    for i in range(10, 100):
+        writer.set(f'key-{i}', i)
+    assert errors == []
+    assert len(dict(reader.items())) == 100
+
+
+def _write_entries(store_cls, pth, worker):
+    store = store_cls(pth)
+    for i in range(20):
+        store.set(f'{worker}-{i}', i)
+
+
+@pytest.mark.parametrize('store_cls', STORES)
+def test_04_concurrent_writers(tmp_path, store_cls):
+    pth = tmp_path / 'store'
+    procs = [
+        multiprocessing.Process(target=_write_entries, args=(store_cls, pth, w)) for w in range(4)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+        assert p.exitcode == 0
+    assert len(dict(store_cls(pth).items())) == 80
+
+
+@pytest.mark.parametrize('store_cls', STORES)
+def test_05_memoize_backend(tmp_path, store_cls):
+    calls = []
+
+    @memoize(tmp_path / 'store', backend=store_cls)
+    def func(x):
+        calls.append(x)
+        return {'x': x}
+
+    assert func(1) == {'x': 1}
+    assert func(1) == {'x': 1}
+    assert calls == [1]
+
+    @memoize(tmp_path / 'store', backend=store_cls)
+    def func2(x):
+        raise AssertionError('must be cached')
+
+    assert func2(1) == {'x': 1}
+    func2.compact()
+
+    func.reset_cache()
+    func(1)
+    assert calls == [1, 1]
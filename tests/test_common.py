@@ -1,15 +1,32 @@
+import asyncio
+from decimal import Decimal
+
 import pytest
 
+import fan_tools.python as fan_python
 from fan_tools.django.fields import ChoicesEnum
 from fan_tools.python import (
+    achunks,
+    afilter,
+    agather_limited,
+    amap,
     areduce,
+    aslide,
     chunks,
+    compile_path,
     dict_contains,
+    dict_mismatch,
     dot_get,
+    dot_get_many,
+    execfile,
     expand_dot,
+    expand_dot_many,
     retry,
     slide,
+    TokenBucket,
     usd_round,
+    usd_round_many,
+    UsdAccumulator,
 )
 
 
@@ -239,3 +256,333 @@ def test_14_dot_get():
     d1 = {'a': None}
     assert dot_get('a.b', d1) is None
     assert dot_get('a.b', d1, None) is None
+
+
+def test_15_retry_per_call(capfd):
+    @retry(tries=2)
+    def func_to_retry():
+        print(1)
+        raise ValueError
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            func_to_retry()
+
+    out, err = capfd.readouterr()
+    assert out == '1\n1\n1\n1\n'
+
+
+def test_16_retry_backoff(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr('time.sleep', sleeps.append)
+
+    @retry(tries=5, backoff=1, max_backoff=5, jitter=False)
+    def func_to_retry():
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        func_to_retry()
+    assert sleeps == [1, 2, 4, 5]
+
+    sleeps.clear()
+
+    @retry(tries=5, backoff=1, retry_after=lambda e: 0.5 if isinstance(e, KeyError) else None)
+    def func_with_retry_after():
+        raise KeyError
+
+    with pytest.raises(KeyError):
+        func_with_retry_after()
+    assert sleeps == [0.5] * 4
+
+
+def test_17_retry_deadline(capfd):
+    @retry(backoff=0.02, jitter=False, deadline=0.05)
+    def func_to_retry():
+        print(1)
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        func_to_retry()
+
+    out, err = capfd.readouterr()
+    # 0.02 + 0.04 > 0.05
+    assert out == '1\n1\n'
+
+
+def test_18_retry_budget(capfd):
+    budget = TokenBucket(rate=0, capacity=3)
+
+    @retry(tries=3, budget=budget)
+    def func_to_retry():
+        print(1)
+        raise ValueError
+
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            func_to_retry()
+
+    out, err = capfd.readouterr()
+    # 2 retries for the first call, 1 for the second, none for the third
+    assert out == '1\n' * 6
+
+
+@pytest.mark.asyncio
+async def test_18_retry_async_backoff(monkeypatch):
+    sleeps = []
+
+    async def fake_sleep(delay):
+        sleeps.append(delay)
+
+    monkeypatch.setattr('asyncio.sleep', fake_sleep)
+
+    @retry(tries=3, backoff=1, jitter=False)
+    async def func_to_retry():
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        await func_to_retry()
+    assert sleeps == [1, 2]
+
+
+def test_19_compile_path():
+    d = {'a': {'b': [{'c': 1}, {'d': 2}, {'c': 3}]}, 'x': {'0': 'zero'}}
+    assert compile_path('a.b.0.c')(d) == 1
+    assert compile_path('a.b.-1.c')(d) == 3
+    assert compile_path('a.b.5.c')(d, default=0) == 0
+    assert compile_path('a.b.*.c')(d) == [1, 3]
+    assert compile_path('a.*')(d) == [d['a']['b']]
+    assert compile_path('a.b.c')(d) is None
+    assert compile_path('x.0')(d) == 'zero'
+    assert compile_path('a/b', sep='/') is compile_path('a/b', sep='/')
+
+    records = [{'a': 1, 'b': {'c': 2}}, {'a': 3}, None]
+    assert list(dot_get_many(['a', 'b.c'], records, default=0)) == [[1, 2], [3, 0], [0, 0]]
+
+
+def test_20_expand_dot_many():
+    assert expand_dot({'a.b': 1, 'a.c.d': 2, 'e': 3, 'a.c.f': 4}) == {
+        'a': {'b': 1, 'c': {'d': 2, 'f': 4}},
+        'e': 3,
+    }
+    records = [{'a.b': i, 'a.c': -i, 'd': None} for i in range(3)]
+    expanded = expand_dot_many(records)
+    assert expanded == [{'a': {'b': i, 'c': -i}, 'd': None} for i in range(3)]
+    assert expanded[0]['a'] is not expanded[1]['a']
+    assert expand_dot_many([{'a/b': 1}], sep='/') == [{'a': {'b': 1}}]
+
+
+def test_21_dict_mismatch():
+    a = {'key': 'aa', 'msg': {'bb': 1, 'items': [{'id': 1, 'x': 1}, {'id': 2}, {'id': 3}]}}
+
+    assert dict_mismatch(a, {'msg': {'bb': 1}}) is None
+    assert dict_mismatch(a, {'msg': {'bb': 2}}) == ('msg', 'bb')
+    assert dict_mismatch(a, {'msg': {'cc': 2}}) == ('msg', 'cc')
+    assert dict_mismatch(a, {'key': {'cc': 2}}) == ('key',)
+    assert dict_mismatch(a, {'msg': {'items': [{'id': 1}]}}) == ('msg', 'items')
+
+    assert dict_contains(a, {'msg': {'items': [{'id': 3}, {'id': 1}]}}, lists='subset')
+    assert dict_mismatch(a, {'msg': {'items': [{'id': 3}, {'id': 4}]}}, lists='subset') == (
+        'msg',
+        'items',
+        1,
+    )
+    assert dict_contains(a, {'msg': {'items': [{'id': 1}, {'id': 3}]}}, lists='ordered')
+    assert dict_mismatch(a, {'msg': {'items': [{'id': 3}, {'id': 1}]}}, lists='ordered') == (
+        'msg',
+        'items',
+        1,
+    )
+    assert dict_contains(a, {'msg': {'items': [{'id': 5}, {'id': 2}]}}, lists='any')
+    assert not dict_contains(a, {'msg': {'items': [{'id': 5}]}}, lists='any')
+
+    assert dict_contains({'tags': {'a', 'b'}}, {'tags': {'a'}}, lists='subset')
+    assert not dict_contains({'tags': {'a', 'b'}}, {'tags': {'a'}})
+    assert dict_contains({'tags': ['a', 'b']}, {'tags': {'c', 'b'}}, lists='any')
+
+    with pytest.raises(ValueError):
+        dict_contains(a, a, lists='unknown')
+
+
+def test_22_dict_contains_deep():
+    superset, subset = {}, {}
+    sup, sub = superset, subset
+    for _ in range(5000):
+        sup['n'], sub['n'] = {'x': 1}, {}
+        sup, sub = sup['n'], sub['n']
+    sup['leaf'], sub['leaf'] = 1, 1
+    assert dict_contains(superset, subset)
+    sub['leaf'] = 2
+    assert len(dict_mismatch(superset, subset)) == 5001
+
+
+@pytest.mark.parametrize('lists', ['subset', 'ordered', 'any'])
+def test_22_dict_contains_deep_lists(lists):
+    superset, subset = 1, 1
+    for _ in range(3000):
+        superset, subset = [{'a': superset}], [{'a': subset}]
+    assert dict_mismatch({'t': superset}, {'t': subset}, lists=lists) is None
+
+
+def test_22_dict_contains_unhashable():
+    assert not dict_contains({'t': [{'a': 1}]}, {'t': {1}}, lists='subset')
+    assert dict_contains({'t': [{'a': 1}, 1]}, {'t': {1}}, lists='subset')
+    assert dict_contains({'t': [{'a': 1}, 1]}, {'t': {1, 2}}, lists='any')
+
+
+def test_23_chunks_iterators():
+    assert list(chunks(iter(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(chunks((x for x in []), 2)) == []
+    assert list(chunks('abcde', 2)) == ['ab', 'cd', 'e']
+    assert list(chunks({'a': 1, 'b': 2, 'c': 3}, 2)) == [['a', 'b'], ['c']]
+
+    class Array:
+        # sliceable, but not a registered Sequence, like numpy arrays
+        def __init__(self, items):
+            self.items = items
+
+        def __len__(self):
+            return len(self.items)
+
+        def __getitem__(self, key):
+            return Array(self.items[key])
+
+        def __iter__(self):
+            raise AssertionError('must be sliced')
+
+    parts = list(chunks(Array([0, 1, 2, 3, 4]), 2))
+    assert [type(p) for p in parts] == [Array] * 3
+    assert [p.items for p in parts] == [[0, 1], [2, 3], [4]]
+    assert list(slide(iter(range(3)))) == [(0, 1), (1, 2), (2, None)]
+    assert list(slide([1, None], 3)) == [(1, None, None), (None, None, None)]
+
+
+@pytest.mark.asyncio
+async def test_24_async_chunks():
+    async def agen(n):
+        for i in range(n):
+            yield i
+
+    assert [c async for c in achunks(agen(5), 2)] == [[0, 1], [2, 3], [4]]
+    assert [c async for c in achunks(agen(0), 2)] == []
+    assert [c async for c in achunks(range(3), 3)] == [[0, 1, 2]]
+
+    assert [w async for w in aslide(agen(3))] == [(0, 1), (1, 2), (2, None)]
+    assert [w async for w in aslide(agen(2), 3)] == [(0, 1, None), (1, None, None)]
+    assert [w async for w in aslide(agen(0))] == []
+
+
+@pytest.mark.asyncio
+async def test_25_async_reduce_tree():
+    async def agen(n):
+        for i in range(n):
+            yield str(i)
+
+    async def concat(a, b):
+        await asyncio.sleep(0)
+        return a + b
+
+    assert await areduce(concat, agen(5)) == '01234'
+    assert await areduce(concat, agen(5), tree=True) == '01234'
+    assert await areduce(concat, agen(6), initial='x', tree=True, limit=2) == 'x012345'
+    assert await areduce(concat, ['a'], tree=True) == 'a'
+    with pytest.raises(TypeError):
+        await areduce(concat, agen(0), tree=True)
+
+
+@pytest.mark.asyncio
+async def test_26_amap_afilter_gather():
+    running = []
+    peak = []
+
+    async def work(x):
+        running.append(x)
+        peak.append(len(running))
+        await asyncio.sleep(0.01 * (x % 3))
+        running.remove(x)
+        return x * 2
+
+    assert [x async for x in amap(work, range(10), limit=3)] == [x * 2 for x in range(10)]
+    assert max(peak) == 3
+
+    peak.clear()
+    assert await agather_limited([work(x) for x in range(10)], 4) == [x * 2 for x in range(10)]
+    assert max(peak) == 4
+    assert await agather_limited([]) == []
+
+    async def is_even(x):
+        await asyncio.sleep(0)
+        return x % 2 == 0
+
+    assert [x async for x in afilter(is_even, range(10), limit=2)] == [0, 2, 4, 6, 8]
+
+    async def fail(x):
+        if x == 1:
+            raise ValueError
+        await asyncio.sleep(1)
+
+    with pytest.raises(ValueError):
+        await agather_limited((fail(x) for x in range(5)), 2)
+
+
+def test_27_usd_round_many():
+    amounts = ['12.9800000003', Decimal('1.005'), 150, '-0.125']
+    assert usd_round_many(amounts) == [
+        Decimal('12.98'),
+        Decimal('1.01'),
+        Decimal('1.50'),
+        Decimal('-0.13'),
+    ]
+    assert usd_round_many(amounts, cents=True) == [1298, 101, 150, -13]
+    assert [str(x) for x in usd_round_many(amounts)] == ['12.98', '1.01', '1.50', '-0.13']
+    with pytest.raises(TypeError):
+        usd_round_many([1.5])
+
+    acc = UsdAccumulator()
+    acc.extend(['0.004'] * 1000)
+    acc.add(1)
+    assert acc.total == Decimal('4.01')
+    assert acc.cents == 401
+    assert acc.count == 1001
+
+
+def test_28_execfile_cache(tmp_path, monkeypatch):
+    settings = tmp_path / 'settings.py'
+    settings.write_text('A = 1\n')
+    compiled = []
+    orig = fan_python._compile_file
+    monkeypatch.setattr(fan_python, '_compile_file', lambda f: compiled.append(f) or orig(f))
+
+    for _ in range(3):
+        scope = {}
+        assert execfile(settings, scope, scope, cache=True)
+        assert scope['A'] == 1
+    assert len(compiled) == 1
+
+    settings.write_text('A = 22\n')
+    scope = {}
+    execfile(settings, scope, scope, cache=True)
+    assert scope['A'] == 22
+    assert len(compiled) == 2
+
+    execfile(settings, scope, scope, persist=True)
+    assert len(compiled) == 2
+    assert list((tmp_path / '__pycache__').glob('settings.py.*.execfile'))
+
+    # new process: in-memory cache is empty, code is loaded from __pycache__
+    fan_python._code_cache.clear()
+    scope = {}
+    execfile(settings, scope, scope, persist=True)
+    assert scope['A'] == 22
+    assert len(compiled) == 2
+
+    # truncated or broken persisted code is compiled again
+    persisted = next((tmp_path / '__pycache__').glob('settings.py.*.execfile'))
+    for data in [persisted.read_bytes()[:7], persisted.read_bytes()[:30], b'']:
+        persisted.write_bytes(data)
+        fan_python._code_cache.clear()
+        scope = {}
+        execfile(settings, scope, scope, persist=True)
+        assert scope['A'] == 22
+    assert len(compiled) == 5
+
+    assert not execfile(tmp_path / 'missing.py', scope, scope, cache=True)
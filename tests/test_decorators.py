@@ -1,8 +1,13 @@
+import asyncio
 import json
 from pathlib import Path
 from unittest.mock import MagicMock
 
-from fan_tools.python import cache_async, memoize
+import pytest
+
+from fan_tools.python import cache_async, CircuitBreaker, CircuitOpenError, memoize, retry
+from fan_tools.python.cache import SqliteStore
+from fan_tools.python.decorators import args_key
 
 
 class TestCache:
@@ -38,6 +43,92 @@ class TestCache:
         func.reset_cache()
 
 
+class Model:
+    def __init__(self, value):
+        self.value = value
+
+    @classmethod
+    def parse_file(cls, fname):
+        return cls(json.loads(Path(fname).read_text()))
+
+    def json(self):
+        return json.dumps(self.value)
+
+
+class TestCacheKeyed:
+    async def test_01_keys(self, tmp_path):
+        calls = []
+
+        @cache_async[Model](tmp_path, Model, None, key=args_key, max_entries=1)
+        async def func(x):
+            calls.append(x)
+            return Model(x)
+
+        assert (await func(1)).value == 1
+        assert (await func(2)).value == 2
+        assert (await func(2)).value == 2
+        assert calls == [1, 2]
+        assert (tmp_path / f'{args_key(1)}.json').read_text() == '1'
+
+        # evicted from memory, loaded from file
+        assert (await func(1)).value == 1
+        assert calls == [1, 2]
+
+        func.reset_cache()
+        assert list(tmp_path.glob('*.json')) == []
+        await func(1)
+        assert calls == [1, 2, 1]
+
+    async def test_02_single_flight(self, tmp_path):
+        calls = []
+
+        @cache_async[Model](tmp_path, Model, None, key=args_key)
+        async def func(x):
+            calls.append(x)
+            await asyncio.sleep(0.01)
+            return Model(x)
+
+        results = await asyncio.gather(*[func(1) for _ in range(5)])
+        assert [r.value for r in results] == [1] * 5
+        assert calls == [1]
+
+    async def test_03_ttl(self, tmp_path):
+        calls = []
+
+        @cache_async[Model](tmp_path, Model, None, key=args_key, ttl=0)
+        async def func(x):
+            calls.append(x)
+            return Model(len(calls))
+
+        assert (await func(1)).value == 1
+        assert (await func(1)).value == 2
+
+    async def test_04_stale_while_revalidate(self, tmp_path):
+        calls = []
+        release = asyncio.Event()
+
+        @cache_async[Model](
+            tmp_path, Model, None, key=args_key, ttl=0, stale_while_revalidate=True
+        )
+        async def func(x):
+            calls.append(x)
+            if len(calls) > 1:
+                await release.wait()
+            return Model(len(calls))
+
+        assert (await func(1)).value == 1
+        # expired: stale value returned while refresh waits
+        assert (await func(1)).value == 1
+        assert (await func(1)).value == 1
+        await asyncio.sleep(0)
+        assert len(calls) == 2
+
+        release.set()
+        await asyncio.sleep(0.05)
+        assert (await func(1)).value == 2
+        assert (tmp_path / f'{args_key(1)}.json').read_text() == '2'
+
+
 class TestMemoize:
     memoized = '{"ab82775f76a7c30b94db389aa2e8702f": "{\\"args\\": [\\"a\\"], \\"kwargs\\": {\\"name\\": \\"b\\"}}"}'
 
@@ -82,3 +173,227 @@ class TestMemoize:
 
         func.reset_cache()
         assert not fname.exists()
+
+    def test_03_memory_tier(self, tmp_path):
+        fname = tmp_path / 'memoized.json'
+        calls = []
+
+        @memoize(fname, max_entries=2)
+        def func(x):
+            calls.append(x)
+            return x * 2
+
+        assert func(1) == 2
+        fname.unlink()
+        # served from memory, the file isn't consulted
+        assert func(1) == 2
+        assert calls == [1]
+
+        func(2)
+        func(3)
+        info = func.cache_info()
+        assert info.hits == 1
+        assert info.evictions == 1
+        assert info.currsize == 2
+
+    def test_04_memory_ttl(self, tmp_path):
+        fname = tmp_path / 'memoized.json'
+        calls = []
+
+        @memoize(fname, ttl=0)
+        def func(x):
+            calls.append(x)
+            return x
+
+        func(1)
+        func(1)
+        # expired in memory, but still served from the file
+        assert calls == [1]
+        assert func.cache_info().hits == 0
+
+    def test_05_warm_from_file(self, tmp_path):
+        fname = tmp_path / 'memoized.json'
+
+        @memoize(fname)
+        def func(x):
+            return x
+
+        func(1)
+
+        @memoize(fname)
+        def func2(x):
+            raise AssertionError('must be cached')
+
+        assert func2(1) == 1
+        assert func2.cache_info().hits == 1
+
+    def test_05_warm_bounded(self, tmp_path, monkeypatch):
+        fname = tmp_path / 'memoized.json'
+
+        @memoize(fname, max_entries=None)
+        def func(x):
+            return x
+
+        for x in range(10):
+            func(x)
+
+        dumps = []
+        json_dumps = json.dumps
+        monkeypatch.setattr(json, 'dumps', lambda v, **kw: dumps.append(v) or json_dumps(v, **kw))
+
+        @memoize(fname, max_entries=3)
+        def func2(x):
+            return x
+
+        assert func2(9) == 9
+        info = func2.cache_info()
+        # only the latest entries are loaded and encoded
+        assert (info.hits, info.evictions, info.currsize) == (1, 0, 3)
+        assert dumps == [{'args': (9,), 'kwargs': {}}, 7, 8, 9]
+
+    async def test_05_results_copied(self, tmp_path):
+        @memoize(tmp_path / 'memoized.json')
+        def func(x):
+            return {'items': [x]}
+
+        @memoize(tmp_path / 'memoized_async.json')
+        async def afunc(x):
+            return {'items': [x]}
+
+        for _ in range(2):
+            func(1)['items'].append(99)
+            (await afunc(1))['items'].append(99)
+        # callers' changes don't get into the cache
+        assert func(1) == await afunc(1) == {'items': [1]}
+        assert func.cache_info().hits == afunc.cache_info().hits == 2
+
+    def test_05_warm_indexed(self, tmp_path, monkeypatch):
+        @memoize(tmp_path / 'memoized.db', backend=SqliteStore)
+        def func(x):
+            return x
+
+        func(1)
+        monkeypatch.setattr(SqliteStore, 'items', None)
+
+        @memoize(tmp_path / 'memoized.db', backend=SqliteStore)
+        def func2(x):
+            raise AssertionError('must be cached')
+
+        assert func2(1) == 1
+        assert func2(1) == 1
+        assert func2.cache_info().hits == 1
+
+    async def test_06_async(self, tmp_path):
+        fname = tmp_path / 'memoized.json'
+        calls = []
+
+        @memoize(fname)
+        async def func(x):
+            calls.append(x)
+            await asyncio.sleep(0.01)
+            return {'x': x}
+
+        results = await asyncio.gather(*[func(1) for _ in range(10)], func(2))
+        assert results == [{'x': 1}] * 10 + [{'x': 2}]
+        assert calls == [1, 2]
+        assert json.loads(fname.read_text()) == {
+            args_key(1): {'x': 1},
+            args_key(2): {'x': 2},
+        }
+        assert await func(1) == {'x': 1}
+        assert func.cache_info().hits == 1
+
+    async def test_07_async_cancel(self, tmp_path):
+        calls = []
+
+        @memoize(tmp_path / 'memoized.json')
+        async def func(x):
+            calls.append(x)
+            await asyncio.sleep(0.01)
+            return x
+
+        first = asyncio.ensure_future(func(1))
+        second = asyncio.ensure_future(func(1))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == 1
+        assert calls == [1]
+
+
+class TestCircuitBreaker:
+    def test_01_open_half_open_close(self, monkeypatch):
+        now = [0.0]
+        monkeypatch.setattr('time.monotonic', lambda: now[0])
+        breaker = CircuitBreaker('test', exceptions=ValueError, window=4, min_calls=4, cooldown=10)
+        fail = True
+
+        @breaker
+        def func():
+            if fail:
+                raise ValueError
+            return 1
+
+        for _ in range(4):
+            with pytest.raises(ValueError):
+                func()
+        assert breaker.state == CircuitBreaker.OPEN
+
+        with pytest.raises(CircuitOpenError) as exc:
+            func()
+        assert exc.value.retry_after == 10
+
+        now[0] = 10
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        # failed trial opens circuit again
+        with pytest.raises(ValueError):
+            func()
+        assert breaker.state == CircuitBreaker.OPEN
+
+        now[0] = 20
+        fail = False
+        assert func() == 1
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.stats() == {
+            'name': 'test',
+            'state': 'closed',
+            'calls': 6,
+            'failures': 5,
+            'rejected': 1,
+            'failure_rate': 0.0,
+        }
+
+    def test_02_failure_rate(self):
+        breaker = CircuitBreaker(exceptions=ValueError, failure_rate=0.5, window=4, min_calls=4)
+
+        @breaker
+        def func(exc):
+            if exc:
+                raise exc
+
+        func(None)
+        # not counted as failure
+        with pytest.raises(KeyError):
+            func(KeyError)
+        with pytest.raises(ValueError):
+            func(ValueError)
+        assert breaker.state == CircuitBreaker.CLOSED
+        with pytest.raises(ValueError):
+            func(ValueError)
+        assert breaker.state == CircuitBreaker.OPEN
+
+    async def test_03_async_with_retry(self):
+        breaker = CircuitBreaker(min_calls=2, window=2, cooldown=0.01)
+        calls = []
+
+        @retry(tries=5, retry_after=lambda e: getattr(e, 'retry_after', None))
+        @breaker
+        async def func():
+            calls.append(1)
+            if len(calls) < 3:
+                raise ValueError
+            return 'ok'
+
+        assert await func() == 'ok'
+        assert len(calls) == 3
+        assert breaker.stats()['rejected'] == 1
+        assert breaker.state == CircuitBreaker.CLOSED
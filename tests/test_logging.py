@@ -1,7 +1,28 @@
+import dataclasses
+import datetime
+import enum
+import json
 import logging
+import math
+import queue
+import socket
+import sys
+import time
+from contextlib import suppress
 from unittest.mock import MagicMock
 
-from fan_tools.fan_logging import setup_logger
+import pytest
+
+from fan_tools.fan_logging import (
+    FastJSFormatter,
+    JSFormatter,
+    QueueHandler,
+    RateLimitFilter,
+    setup_logger,
+)
+from fan_tools.fan_logging import handlers
+from fan_tools.fan_logging.handlers import SysLogHandler
+from fan_tools.metrics import send_error_metric, send_metric
 
 
 def test_01_js_formatter(tmp_path):
@@ -10,3 +31,373 @@ def test_01_js_formatter(tmp_path):
     mm.assert_not_called()
     logging.debug('test')
     mm.assert_called_once()
+
+
+def test_02_queue(tmp_path):
+    mm = MagicMock(return_value={'span': 'abc'})
+    handler = setup_logger(
+        'in_test', root_dir=tmp_path, enable_queue=True, json_params={'get_context': mm}
+    )
+    try:
+        logging.info('test %s', 'queue')
+        mm.assert_called_once()
+        send_metric('metric', tags={'a': 1})
+    finally:
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+    record, metric = map(json.loads, (tmp_path / 'in_test.json_log').read_text().splitlines())
+    assert record['message'] == 'test queue'
+    assert record['span'] == 'abc'
+    assert 'test queue' in (tmp_path / 'plain' / 'in_test.log').read_text()
+    assert metric['message'] == 'metric'
+    assert metric['tags']['a'] == 1
+
+
+def test_02_queue_record_copy():
+    handler = QueueHandler(queue.Queue())
+    logger = logging.getLogger('test_02_queue_record_copy')
+    logger.addHandler(handler)
+    records = []
+    logger.addFilter(lambda record: records.append(record) or True)
+    try:
+        logger.warning('record %s', 1)
+    finally:
+        logger.removeHandler(handler)
+    queued = handler.queue.get_nowait()
+    assert queued is not records[0]
+    assert (queued.msg, queued.args) == ('record 1', None)
+    assert (records[0].msg, records[0].args) == ('record %s', (1,))
+
+
+def test_03_queue_drop():
+    handler = QueueHandler(queue.Queue(1))
+    logger = logging.getLogger('test_03_queue_drop')
+    logger.addHandler(handler)
+    try:
+        for i in range(3):
+            logger.warning('record %s', i)
+    finally:
+        logger.removeHandler(handler)
+    assert handler.dropped == 2
+    assert handler.queue.get_nowait().msg == 'record 0'
+
+
+class Color(enum.Enum):
+    RED = 1
+
+
+class Size(enum.IntEnum):
+    BIG = 2
+
+
+@dataclasses.dataclass
+class Point:
+    x: int
+
+
+@pytest.mark.parametrize('encoder', ['json', 'auto', 'orjson'])
+def test_04_fast_js_formatter(encoder):
+    if encoder == 'orjson':
+        pytest.importorskip('orjson')
+    record = logging.LogRecord('x', logging.ERROR, __file__, 1, 'hello %s', ('world',), None)
+    record.day = datetime.date(2020, 1, 2)
+    record.color = Color.RED
+    record.size = Size.BIG
+    record.point = Point(1)
+    record.ratio = float('nan')
+    record._private = 1
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        record.exc_info = sys.exc_info()
+    context = {'span': 'abc'}
+
+    expected = json.loads(JSFormatter(get_context=lambda: context).format(record))
+    fast = FastJSFormatter(get_context=lambda: context, json_encoder=encoder)
+    out = json.loads(fast.format(record))
+    assert expected['day'] == '2020-01-02'
+    assert expected['color'] == 'Color.RED' and expected['size'] == 2
+    assert expected['point'] == 'Point(x=1)'
+    assert math.isnan(expected.pop('ratio'))
+    if fast.dumps.__name__ == 'orjson_dumps':
+        # differences documented in get_json_dumps
+        assert (out.pop('color'), out.pop('ratio')) == (1, None)
+        expected.pop('color')
+    else:
+        assert math.isnan(out.pop('ratio'))
+    assert out == expected
+
+    # orjson falls back to json module for integers over 64 bits
+    record.huge = 2**70
+    del record.ratio
+    expected = json.loads(JSFormatter(get_context=lambda: context).format(record))
+    assert json.loads(fast.format(record)) == expected
+    assert expected['huge'] == 2**70
+
+    fast = FastJSFormatter(drop_fields=['asctime', 'relativeCreated'], json_encoder=encoder)
+    record.asctime = 'stale'
+    out = json.loads(fast.format(record))
+    assert out['message'] == 'hello world'
+    assert 'asctime' not in out and 'relativeCreated' not in out
+
+
+def read_octet_frames(data):
+    frames = []
+    while data:
+        size, data = data.split(b' ', 1)
+        frames.append(data[: int(size)])
+        data = data[int(size) :]
+    return frames
+
+
+def make_syslog_logger(name, handler):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.addHandler(handler)
+    return logger
+
+
+def test_05_syslog_batch_tcp():
+    server = socket.create_server(('127.0.0.1', 0))
+    handler = SysLogHandler(
+        server.getsockname(), socktype=socket.SOCK_STREAM, batch=True, reconnect_delay=0.05
+    )
+    logger = make_syslog_logger('test_05_syslog_batch_tcp', handler)
+    try:
+        for i in range(100):
+            logger.warning('record %s', i)
+        conn, _ = server.accept()
+        handler.flush()
+        conn.settimeout(1)
+        data = b''
+        while data.count(b'record') < 100:
+            data += conn.recv(65536)
+        frames = read_octet_frames(data)
+        assert frames[0] == b'<12>record 0'
+        assert frames[-1] == b'<12>record 99'
+
+        # server restarts: records are kept and sent after reconnect
+        conn.close()
+        port = server.getsockname()[1]
+        server.close()
+        for i in range(5):
+            logger.warning('spilled %s', i)
+            time.sleep(0.02)
+        server = socket.create_server(('127.0.0.1', port))
+        conn, _ = server.accept()
+        handler.flush()
+        conn.settimeout(1)
+        data = b''
+        while data.count(b'spilled') < 5:
+            data += conn.recv(65536)
+        assert read_octet_frames(data)[-1] == b'<12>spilled 4'
+        conn.close()
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+        server.close()
+
+
+def test_06_syslog_batch_spill():
+    handler = SysLogHandler(
+        ('127.0.0.1', 9), socktype=socket.SOCK_STREAM, batch=True, spill_records=3
+    )
+    logger = make_syslog_logger('test_06_syslog_batch_spill', handler)
+    try:
+        for i in range(10):
+            logger.warning('record %s', i)
+        handler.flush(timeout=0.2)
+        assert handler.dropped == 7
+        assert list(handler.frames) == [b'<12>record 7', b'<12>record 8', b'<12>record 9']
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def test_07_syslog_reconnect(monkeypatch):
+    resolved = []
+    socket_getaddrinfo = socket.getaddrinfo
+
+    def getaddrinfo(*args):
+        resolved.append(args)
+        return socket_getaddrinfo(*args)
+
+    monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+    monkeypatch.setattr(handlers, '_addrinfo_cache', {})
+
+    server = socket.create_server(('127.0.0.1', 0))
+    address = server.getsockname()
+    server.close()
+    handler = SysLogHandler(
+        ('localhost', address[1]),
+        socktype=socket.SOCK_STREAM,
+        reconnect_delay=0.02,
+        spill_records=250,
+    )
+    logger = make_syslog_logger('test_07_syslog_reconnect', handler)
+    try:
+        assert handler.reconnecting
+        for i in range(300):
+            logger.warning('record %s', i)
+        assert len(handler.frames) == 250 and handler.dropped == 50
+        assert handler.buffered == sum(len(f) for f in handler.frames)
+
+        # replayed in several slices, records emitted meanwhile go after them
+        server = socket.create_server(address)
+        conn, _ = server.accept()
+        conn.settimeout(1)
+        logger.warning('record 300')
+        data = b''
+        while data.count(b'\0') < 251:
+            data += conn.recv(65536)
+        assert data.split(b'\0')[:251] == [b'<12>record %d' % i for i in range(50, 301)]
+        assert not handler.reconnecting
+        assert handler.buffered == 0
+        # connect failures drop cached addresses, then it's resolved once per ttl
+        assert 2 <= len(resolved) < 10
+        conn.close()
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+        server.close()
+
+
+@pytest.mark.parametrize('batch', [False, True])
+def test_08_syslog_udp_address_change(monkeypatch, batch):
+    servers = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(2)]
+    for server in servers:
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(1)
+    resolved = []
+    current = [servers[0].getsockname()]
+
+    def getaddrinfo(host, port, family, socktype):
+        resolved.append(host)
+        return [(socket.AF_INET, socket.SOCK_DGRAM, 17, '', current[0])]
+
+    monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+    monkeypatch.setattr(handlers, '_addrinfo_cache', {})
+    handler = SysLogHandler(
+        ('syslog.test', 514), socktype=socket.SOCK_DGRAM, batch=batch, resolve_ttl=0.01
+    )
+    logger = make_syslog_logger(f'test_08_syslog_udp_address_change_{batch}', handler)
+    try:
+        logger.warning('first')
+        assert servers[0].recv(1024) == b'<12>first\0'
+
+        # server is restarted with a new address
+        current[0] = servers[1].getsockname()
+        servers[1].setblocking(False)
+        for i in range(50):
+            time.sleep(0.02)
+            logger.warning('moved %s', i)
+            with suppress(BlockingIOError):
+                assert servers[1].recv(1024).startswith(b'<12>moved')
+                break
+        else:
+            raise AssertionError('address is not refreshed')
+        assert len(resolved) >= 2
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+        for server in servers:
+            server.close()
+
+
+def test_08_getaddrinfo_cached(monkeypatch):
+    monkeypatch.setattr(handlers, '_addrinfo_cache', {})
+    result = handlers.getaddrinfo_cached('localhost', 514, socket.SOCK_DGRAM, ttl=0)
+
+    def fail(*args):
+        raise socket.gaierror('dns is down')
+
+    monkeypatch.setattr(socket, 'getaddrinfo', fail)
+    assert handlers.getaddrinfo_cached('localhost', 514, socket.SOCK_DGRAM, ttl=0) == result
+    with pytest.raises(socket.gaierror):
+        handlers.getaddrinfo_cached('localhost', 515, socket.SOCK_DGRAM, ttl=0)
+
+
+@pytest.mark.parametrize('enable_queue', [False, True])
+def test_09_rate_limit(tmp_path, enable_queue):
+    setup_logger(
+        'in_test',
+        root_dir=tmp_path,
+        enable_stdout=False,
+        enable_queue=enable_queue,
+        rate_limit={'rate': 0.001, 'burst': 3, 'summary_interval': 0.1},
+    )
+    log = logging.getLogger('test_09_rate_limit')
+    root_handler = logging.getLogger().handlers[0]
+    rate_limit = root_handler.filters[0]
+    try:
+        for i in range(10):
+            log.warning('noisy %s', i)
+        log.warning('other')
+        log.error('broken %s', 1)
+        log.error('broken %s', 2)
+        # summary is logged by timer, even if nothing is logged after the noisy loop
+        for _ in range(50):
+            if not rate_limit.suppressed:
+                break
+            time.sleep(0.01)
+    finally:
+        if enable_queue:
+            logging.getLogger().removeHandler(root_handler)
+            root_handler.close()
+        else:
+            for handler in logging.getLogger().handlers:
+                handler.removeFilter(rate_limit)
+
+    records = [
+        json.loads(line) for line in (tmp_path / 'in_test.json_log').read_text().splitlines()
+    ]
+    messages = [r['message'] for r in records]
+    assert messages == [
+        'noisy 0',
+        'noisy 1',
+        'noisy 2',
+        'other',
+        'broken 1',
+        'broken 2',
+        'Suppressed 7 similar records: noisy %s',
+    ]
+    assert records[-1]['suppressed'] == 7
+    # json and plain handlers share the filter, each record is counted once
+    plain = (tmp_path / 'plain' / 'in_test.log').read_text()
+    assert plain.count('noisy') == 4
+
+
+def test_10_sample():
+    rate_limit = RateLimitFilter(rate=1, burst=1000, sample=0.5, error_rate=1, error_burst=1)
+    passed = 0
+    for i in range(1000):
+        record = logging.LogRecord('x', logging.INFO, __file__, 1, 'sampled %s', (i,), None)
+        passed += rate_limit.filter(record)
+        assert rate_limit.filter(record) == rate_limit.filter(record)
+    assert 400 < passed < 600
+    errors = [
+        rate_limit.filter(logging.LogRecord('x', logging.ERROR, __file__, 1, 'err', (), None))
+        for _ in range(3)
+    ]
+    assert errors == [True, False, False]
+
+
+def test_10_metrics_not_limited(monkeypatch):
+    rate_limit = RateLimitFilter(rate=0.001, burst=3, error_rate=0.001, error_burst=1)
+    handler = MagicMock(level=logging.DEBUG)
+    metric_logger = logging.getLogger('fan.metric')
+    monkeypatch.setattr(metric_logger, 'propagate', False)
+    monkeypatch.setattr(metric_logger, 'handlers', [handler])
+    monkeypatch.setattr(metric_logger, 'filters', [rate_limit])
+    level = metric_logger.level
+    metric_logger.setLevel(logging.INFO)
+    try:
+        for name in ['a', 'b', 'c', 'd', 'e', 'a', 'a']:
+            send_metric(name)
+        send_error_metric('x')
+        send_error_metric('y')
+    finally:
+        metric_logger.setLevel(level)
+    messages = [c.args[0].msg['message'] for c in handler.handle.call_args_list]
+    assert messages == ['a', 'b', 'c', 'd', 'e', 'a', 'a', 'error_metric', 'error_metric']
+    assert not rate_limit.suppressed
@@ -2,6 +2,7 @@ from pathlib import Path
 
 import pytest
 
+import fan_tools.python as fan_python
 from fan_tools.python import auto_directory, py_rel_path, rel_path
 from fan_tools.unix import cd
 
@@ -27,3 +28,27 @@ def test_03_auto_directory(tmpdir):
     assert not pth.exists(), (pth, tmpdir)
     auto_directory(pth)
     assert pth.exists()
+
+
+def test_04_rel_path_cache(tmpdir):
+    fan_python._resolve_rel_path.cache_clear()
+    first = rel_path('./test_rel_path.py', check=True)
+    assert rel_path('./test_rel_path.py', check=True) is first
+    assert fan_python._resolve_rel_path.cache_info().hits == 1
+
+    missing = Path(tmpdir / 'missing')
+    with pytest.raises(Exception):
+        rel_path(str(missing), check=True)
+    missing.mkdir()
+    assert rel_path(str(missing), check=True) == missing
+
+
+def test_05_auto_directory_once(tmpdir, monkeypatch):
+    pth = Path(tmpdir / 'created_once')
+    calls = []
+    orig = Path.mkdir
+    monkeypatch.setattr(Path, 'mkdir', lambda self, **kw: calls.append(self) or orig(self, **kw))
+    auto_directory(pth)
+    auto_directory(pth)
+    assert calls == [pth]
+    assert pth.exists()
@@ -56,3 +56,18 @@ class TestRootDirectory:
         assert root_directory(pathlib.Path(tmpdir), exclude=["__MACOS", "EXCLUDE"]) == pathlib.Path(
             f'{tmpdir}/root_dir'
         )
+
+    def test_single_file_and_empty(self, tmpdir):
+        assert root_directory(pathlib.Path(tmpdir)) == pathlib.Path('')
+        tmpdir.mkdir('root_dir').mkdir('sub').join('file.txt').write('')
+        assert root_directory(pathlib.Path(tmpdir)) == pathlib.Path(f'{tmpdir}/root_dir/sub')
+
+    def test_zip_no_common_root(self):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as zip:
+            for name in ['a/file.txt', 'b/file.txt', '__MACOSX/a/file.txt']:
+                zip.writestr(name, '')
+        assert root_directory(io.BytesIO(buf.getvalue())) == pathlib.Path('')
+        assert root_directory(
+            io.BytesIO(buf.getvalue()), exclude=['__MACOSX', 'b/']
+        ) == pathlib.Path('a')